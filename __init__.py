@@ -11,26 +11,38 @@ from singleshot import *
 from app import *
 from robot import *
 from livecam import *
+from governor import *
+import signal
 
 lineFollowTime = 2.5
 
 # initialize robot
 robot = Robot()
 
-# define paths and information about the tensorflow model
-labels = ["background", "crocs", "recycling", "skateboard", "studentid", "tidepods"]
-protoPath = "graph.pbtxt"
-modelPath = "frozen_inference_graph.pb"
-confidenceErrorMargin = 0.2
+# the model paths, labels and confidence margin are defined in singleshot.py
+# use the graph from optimizegraph.py if it has been generated
+if os.path.exists(optimizedProtoPath):
+	protoPath = optimizedProtoPath
+# modes that look for small, distant objects in tiles when the whole frame finds nothing
+# the extra pass is too slow to be worth it when nobody is searching, and in search it is only
+# worth it on frames taken while the robot is paused, not on blurred ones from line following
+tiledModes = ["search", "retrieve", "findcrocs", "finddoor"]
 
 # initialize detector
 detector = SSD(protoPath, modelPath, labels, confidenceErrorMargin)
+detector.robot = robot
 
 # initialize cameras and application window
 SSD.initCamera()
-liveCamera = piCam()
+liveCamera = LiveCamera(PiCameraSource())
+liveCamera.start()
 videoDisplay = App(robot)
 robot.videoDisplay = videoDisplay
+# the profiler can also be toggled from outside, with kill -USR1 <pid>
+# stopping it joins a thread and writes files, so the handler only asks and the main loop toggles it
+def requestProfilerToggle(signalNumber, frame):
+	videoDisplay.profilerToggleRequested = True
+signal.signal(signal.SIGUSR1, requestProfilerToggle)
 
 # run detector once before entering the loop
 detectorThread = DetectorThread(detector)
@@ -38,43 +50,62 @@ detectorThread.start()
 detectorThread.join()
 robot.detector = detector
 
-# run the live camera once before entering the loop
-liveCameraThread = piCamThread(liveCamera)
-liveCameraThread.start()
-liveCameraThread.join()
+# wait for the live camera stream to deliver its first frame before entering the loop
+liveCamera.waitForFrame(5)
+liveCameraSequence = 0
+
+# the governor decides how often each part of the loop runs in the current mode
+governor = Governor(videoDisplay, robot, liveCamera)
+inferenceShown = False # the first inference ran before the loop and still needs drawing
 
 # infinite loop to control threads
 while True:
-	# if the detector has finished the last frame, begin processing another
+	now = time.monotonic()
+	governor.update(now)
+	# if the detector has finished the last frame, show it and begin processing another when due
 	if not detectorThread.isAlive():
-		videoDisplay.canvas.delete("all")
-		videoDisplay.drawImage(detector.getCurrTkImage(), "left")
-		videoDisplay.drawBounds(detector.labelData)
-		videoDisplay.drawLabels(detector.labelData)
-		videoDisplay.drawMap()
-		detectorThread = DetectorThread(detector)
-		detectorThread.start()
-		# tell the active robot thread that a new tensorflow inference is available
-		if not robot.thread == None:
-			robot.thread.tfFinished()
-	# if the live camera has finished taking an image, take another
-	if not liveCameraThread.isAlive():
+		if not inferenceShown:
+			governor.inferenceFinished()
+			videoDisplay.canvas.delete("all")
+			governor.lastRun["gui"] = 0 # the menu was deleted too, redraw it before the canvas is next painted
+			videoDisplay.drawImage(detector.getCurrTkImage(), "left")
+			videoDisplay.drawBounds(detector.labelData)
+			videoDisplay.drawLabels(detector.labelData)
+			videoDisplay.drawMap()
+			if hasattr(videoDisplay, "rightImg"): # put the last live frame back until the next one
+				videoDisplay.drawImage(videoDisplay.rightImg, "right")
+			inferenceShown = True
+			# tell the mission engine that a new tensorflow inference is available
+			robot.engine.tfFinished()
+		if governor.ready("inference", now):
+			detector.tiled = videoDisplay.mode in tiledModes and (not videoDisplay.mode == "search" or robot.engine.pauseFlag)
+			detectorThread = DetectorThread(detector)
+			detectorThread.start()
+			governor.inferenceStarted()
+			inferenceShown = False
+	# if the live camera has streamed a new frame, show it when due
+	if not liveCamera.sequence == liveCameraSequence and governor.ready("liveCam", now):
+		liveCameraSequence = liveCamera.sequence
 		videoDisplay.canvas.delete("liveCam")
-		videoDisplay.drawImage(liveCamera.getCurrTkImage(), "right")
-		liveCameraThread = piCamThread(liveCamera)
-		liveCameraThread.start()
+		videoDisplay.drawImage(liveCamera.getCurrTkImage(governor.liveDisplaySize()), "right")
 	# if robot has line followed long enough, pause to take an image
-	if videoDisplay.mode == "search" and not robot.thread.pauseFlag and time.time() - lineFollowTime > videoDisplay.startTime:
-		robot.thread.pause()
-	if videoDisplay.mode == "help":
-		videoDisplay.drawHelp()
-	else:
-		videoDisplay.drawButtons()
-		videoDisplay.drawPosition()
-	videoDisplay.lines = robot.linesensors.readLineValues()
-	videoDisplay.drawLines()
+	if videoDisplay.mode == "search" and not robot.engine.pauseFlag and time.time() - lineFollowTime > videoDisplay.startTime:
+		robot.engine.pause()
+	if governor.ready("gui", now):
+		if videoDisplay.mode == "help":
+			videoDisplay.drawHelp()
+		else:
+			videoDisplay.drawButtons()
+			videoDisplay.drawPosition()
+		videoDisplay.lines = robot.linesensors.readLineValues()
+		videoDisplay.drawLines()
+	# process tkinter events every iteration so clicks and key presses are never held up, only the drawing is throttled
 	videoDisplay.root.update()
+	if videoDisplay.profilerToggleRequested:
+		videoDisplay.profilerToggleRequested = False
+		videoDisplay.toggleProfiler()
 	if videoDisplay.quitting:
-		liveCameraThread.join()
+		liveCamera.stop()
 		videoDisplay.root.destroy()
 		break
+	time.sleep(governor.idleTime())
@@ -6,6 +6,7 @@
 from tkinter import *
 import time
 from detections import *
+from profiler import *
 
 # class for the main app
 class App(object):
@@ -34,27 +35,29 @@ class App(object):
 		self.root.bind("<Return>", self.enter)
 		self.selectedButton = 0
 		self.selectedColumn = 0
-		self.numButtons = [4, 3]
-		self.buttonList = [["Teleop", "Find Key", "Help", "Quit"], ["Pick Up Key", "Drive to Crocs", "Drive to Door"]]
+		self.numButtons = [4, 4]
+		self.buttonList = [["Teleop", "Find Key", "Help", "Quit"], ["Pick Up Key", "Drive to Crocs", "Drive to Door", "Start Profiler"]]
 		self.mode = "idle"
 		self.startTime = 0
 		self.quitting = False
 		self.mapWidth = 190
 		self.mapHeight = 170
 		self.finished = False
+		self.profiler = SamplingProfiler()
+		self.profilerToggleRequested = False # set on SIGUSR1, the main loop does the toggle
 		
 	# method for left arrow
 	def left(self, event):
 		if self.mode == "teleop":
 			self.robot.drive("left")
-		elif self.mode == "idle" and not self.selectedButton == 3:
+		elif self.mode == "idle":
 			self.selectedColumn = (self.selectedColumn + 1) % 2
 
 	# method for right arrow
 	def right(self, event):
 		if self.mode == "teleop":
 			self.robot.drive("right")
-		elif self.mode == "idle" and not self.selectedButton == 3:
+		elif self.mode == "idle":
 			self.selectedColumn = (self.selectedColumn + 1) % 2
 
 	# method for up arrow
@@ -84,8 +87,8 @@ class App(object):
 				elif self.selectedButton == 2:
 					self.mode = "help"
 				elif self.selectedButton == 3:
-					if not self.robot.thread == None:
-						self.robot.stopCurrentThread()
+					self.robot.shutdown()
+					self.profiler.stop()
 					self.quitting = True
 			else:
 				if self.selectedButton == 0:
@@ -97,12 +100,22 @@ class App(object):
 				elif self.selectedButton == 2:
 					self.mode = "finddoor"
 					self.robot.findDoor()
+				elif self.selectedButton == 3:
+					self.toggleProfiler()
 		elif self.mode == "teleop" or self.mode == "help":
 			self.mode = "idle"
 			self.robot.stop()
-		else: # robot is running a movement/action thread
+		else: # robot is running an autonomous stage
 			self.mode = "idle"
-			self.robot.stopCurrentThread()
+			self.robot.stopCurrentStage()
+
+	# start or stop the sampling profiler, also called by the main loop after a SIGUSR1
+	def toggleProfiler(self):
+		self.profiler.toggle()
+		if self.profiler.running:
+			self.buttonList[1][3] = "Stop Profiler"
+		else:
+			self.buttonList[1][3] = "Start Profiler"
 
 	# draw an image on the canvas
 	def drawImage(self, img, location):
@@ -173,7 +186,7 @@ class App(object):
 	def drawLabels(self, labels):
 		buttonW = 125
 		self.canvas.create_text(self.margin * 3 + 2 * buttonW, 2 * self.margin + self.imageSize,\
-			text="Objects seen so far:\n" + "\n".join(Detection.detectedLabels), fill="black", anchor="nw")
+			text="Objects seen so far:\n" + "\n".join(self.robot.detector.memory.seenLabels()), fill="black", anchor="nw")
 
 	# draw the help instructions
 	def drawHelp(self):
@@ -189,7 +202,9 @@ that mode. The left image is used for
 inference and the right is a live feed.
 The vertical bars display line sensor
 data and the lower right is a map that
-displays the robot's estimated position."""
+displays the robot's estimated position.
+The profiler button records where each
+thread spends its time in profiles/."""
 		self.canvas.create_text(self.margin, 2 * self.margin + self.imageSize, text=helpText, tags="gui", anchor="nw")
 
 	# draw the static map in the lower right corner
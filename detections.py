@@ -1,19 +1,71 @@
 # detections.py
-# Defines the Detection class, which stores information about a detected object and all objects.
+# Defines the ObjectMemory class, which remembers every object the detector has seen, when and where.
 
-# Detection class, used to keep track of what has already been seen
-class Detection(object):
-	detectedLabels = set()
-	
-	# constructor, take name of detected object
-	def __init__(self, name):
-		self.name = name
-		detectedLabels.add(name)
+import threading
+import time
+from collections import namedtuple
+import numpy as np
 
-	# use the name for comparisons (hash and eq)
-	def __hash__(self):
-		return hash(self.name)
-		
-	# use the name for comparisons (hash and eq)
-	def __eq__(self, other):
-		return isinstance(other, DetectedObject) and self.name == other.name
+# one remembered object, x is the horizontal centre of the last sighting from 0 (left) to 1 (right)
+Sighting = namedtuple("Sighting", ["count", "firstSeen", "lastSeen", "confidence", "position", "accuratePosition", "x"])
+
+# ObjectMemory class, keeps one record per label id in flat arrays
+# only the detector thread writes, any thread can read without copying or locking
+class ObjectMemory(object):
+	__slots__ = ("labels", "labelIds", "counts", "firstSeen", "lastSeen", "bestConfidence",\
+		"position", "accuratePosition", "lastX", "version", "writeLock")
+
+	# constructor, takes the label list of the model, the index of a label is its id
+	def __init__(self, labels):
+		self.labels = labels
+		self.labelIds = {label: i for i, label in enumerate(labels)}
+		self.counts = np.zeros(len(labels), dtype=np.int64) # number of frames the object was in
+		self.firstSeen = np.zeros(len(labels))
+		self.lastSeen = np.zeros(len(labels))
+		self.bestConfidence = np.zeros(len(labels))
+		self.position = np.zeros(len(labels)) # robot.position at the last sighting
+		self.accuratePosition = np.zeros(len(labels)) # robot.accuratePosition at the last sighting
+		self.lastX = np.zeros(len(labels))
+		self.version = 0 # odd while a write is in progress, readers retry if it changes under them
+		self.writeLock = threading.Lock()
+
+	# record the objects in one frame, takes label ids, confidences and horizontal centres (0 to 1)
+	def record(self, labelIds, confidences, centres, position=0, accuratePosition=0, timestamp=None):
+		if timestamp == None:
+			timestamp = time.time()
+		# only the most confident sighting of each label in a frame is kept
+		best = {}
+		for labelId, confidence, x in zip(labelIds, confidences, centres):
+			if not labelId in best or confidence > best[labelId][0]:
+				best[labelId] = (confidence, x)
+		with self.writeLock:
+			self.version += 1
+			for labelId, (confidence, x) in best.items():
+				if self.counts[labelId] == 0:
+					self.firstSeen[labelId] = timestamp
+				self.counts[labelId] += 1
+				self.lastSeen[labelId] = timestamp
+				self.bestConfidence[labelId] = max(self.bestConfidence[labelId], confidence)
+				self.position[labelId] = position
+				self.accuratePosition[labelId] = accuratePosition
+				self.lastX[labelId] = x
+			self.version += 1
+
+	# returns the Sighting for a label name, or None if it has never been seen
+	def sighting(self, name):
+		labelId = self.labelIds[name]
+		while True:
+			version = self.version
+			if version % 2 == 0:
+				sighting = Sighting(int(self.counts[labelId]), self.firstSeen[labelId], self.lastSeen[labelId],\
+					self.bestConfidence[labelId], self.position[labelId], self.accuratePosition[labelId], self.lastX[labelId])
+				if self.version == version:
+					break
+			time.sleep(0) # let the writer finish
+		if sighting.count == 0:
+			return None
+		return sighting
+
+	# returns the names of all objects seen so far, in label order
+	def seenLabels(self):
+		return [self.labels[i] for i in np.flatnonzero(self.counts) if i > 0] # id 0 is the background
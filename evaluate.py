@@ -0,0 +1,237 @@
+# evaluate.py
+# This file runs the SSD over a directory of annotated images offline and measures how well it does.
+# It reports per-class precision and recall over a sweep of confidence thresholds, per-class average
+# precision and mAP, and images per second for each input size, so model files and thresholds can be
+# compared before they are put on the robot.  With --tiled, images where the whole frame finds nothing
+# above the robot's confidence margin get the same tiled second look the robot gives them.
+# Annotations are Pascal VOC xml files next to each image with the same name (as written by labelImg).
+# Example: python evaluate.py testImages --sizes 300 224 --workers 4 --tiled --output report
+
+import argparse
+import json
+import os
+import time
+import xml.etree.ElementTree as ElementTree
+from multiprocessing import Pool, cpu_count
+import numpy as np
+import cv2
+from singleshot import *
+
+imageExtensions = (".jpg", ".jpeg", ".png", ".bmp")
+
+# the detector of each worker process, the network can't be shared between processes
+workerDetector = None
+
+# runs once in each worker process, loads the network
+def initWorker(protoPath, modelPath, labels, confidenceFloor, tiled):
+	global workerDetector
+	# one opencv thread per worker, so workers don't fight over the cores and each forward pass is
+	# timed the way it runs on the robot's single core
+	cv2.setNumThreads(1)
+	workerDetector = SSD(protoPath, modelPath, labels, confidenceFloor, tiled=tiled)
+
+# runs in a worker process, returns the detections above the floor for one image at one input size,
+# the time taken, and whether the tiled pass was needed
+def detectImage(task):
+	path, inputSize = task
+	image = cv2.imread(path)
+	start = time.perf_counter()
+	detectedObjects = workerDetector.forward(image, inputSize)
+	detectedObjects = detectedObjects[detectedObjects[:, 2] > workerDetector.confidenceErrorMargin]
+	# the robot only looks again in tiles when nothing passes its own confidence margin
+	usedTiles = workerDetector.tiled and not (detectedObjects[:, 2] > confidenceErrorMargin).any()
+	if usedTiles:
+		workerDetector.imageSize = inputSize
+		boxes, confidences, labelIndices = workerDetector.detectTiled(image)
+		detectedObjects = np.column_stack((np.zeros(len(boxes)), labelIndices, confidences, boxes))
+	seconds = time.perf_counter() - start
+	return path, inputSize, detectedObjects[:, 1:7].tolist(), seconds, usedTiles
+
+# read the ground truth boxes of an image from its VOC xml file
+# returns a list of (label index, corners from 0 to 1), skipping names the model doesn't know
+def readAnnotation(xmlPath, labels):
+	root = ElementTree.parse(xmlPath).getroot()
+	width = float(root.find("size/width").text)
+	height = float(root.find("size/height").text)
+	objects = []
+	for obj in root.findall("object"):
+		name = obj.find("name").text
+		if not name in labels:
+			continue
+		box = obj.find("bndbox")
+		objects.append((labels.index(name), (float(box.find("xmin").text) / width, float(box.find("ymin").text) / height,\
+			float(box.find("xmax").text) / width, float(box.find("ymax").text) / height)))
+	return objects
+
+# find the annotated images in a directory, returns a dictionary of image path to ground truth
+def loadDataset(directory, labels):
+	dataset = {}
+	for fileName in sorted(os.listdir(directory)):
+		stem, extension = os.path.splitext(fileName)
+		xmlPath = os.path.join(directory, stem + ".xml")
+		if extension.lower() in imageExtensions and os.path.exists(xmlPath):
+			dataset[os.path.join(directory, fileName)] = readAnnotation(xmlPath, labels)
+	return dataset
+
+# intersection over union of one box with an array of boxes
+def overlaps(box, boxes):
+	boxes = np.asarray(boxes).reshape(-1, 4)
+	w = np.maximum(0, np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0]))
+	h = np.maximum(0, np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1]))
+	intersection = w * h
+	union = (box[2] - box[0]) * (box[3] - box[1]) + (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) - intersection
+	return intersection / np.maximum(union, 1e-9)
+
+# match detections to ground truth, most confident first, the same way VOC does
+# because matching goes in order of confidence, the matches above any threshold are the same as
+# matching only the detections above it, so one pass serves the whole threshold sweep
+# returns, per label index, the confidences of all detections, whether each was a true positive,
+# and the number of ground truth objects
+def matchDetections(detections, dataset, labels, iouThreshold):
+	results = {}
+	for labelIndex in range(1, len(labels)):
+		confidences = []
+		truePositives = []
+		groundTruthCount = 0
+		for path, groundTruth in dataset.items():
+			truthBoxes = [box for truthLabel, box in groundTruth if truthLabel == labelIndex]
+			groundTruthCount += len(truthBoxes)
+			matched = [False] * len(truthBoxes)
+			rows = sorted([row for row in detections[path] if int(row[0]) == labelIndex], key=lambda row: -row[1])
+			for row in rows:
+				confidences.append(row[1])
+				isMatch = False
+				if truthBoxes:
+					iou = overlaps(row[2:6], truthBoxes)
+					best = int(iou.argmax())
+					if iou[best] >= iouThreshold and not matched[best]:
+						matched[best] = True
+						isMatch = True
+				truePositives.append(isMatch)
+		order = np.argsort(confidences)[::-1]
+		results[labelIndex] = (np.array(confidences)[order], np.array(truePositives, dtype=bool)[order], groundTruthCount)
+	return results
+
+# VOC all-point interpolated average precision for one class
+def averagePrecision(truePositives, groundTruthCount):
+	if groundTruthCount == 0:
+		return None
+	if len(truePositives) == 0:
+		return 0.0
+	tpCumulative = np.cumsum(truePositives)
+	recall = tpCumulative / groundTruthCount
+	precision = tpCumulative / np.arange(1, len(truePositives) + 1)
+	recall = np.concatenate(([0.0], recall, [1.0]))
+	precision = np.concatenate(([0.0], precision, [0.0]))
+	precision = np.maximum.accumulate(precision[::-1])[::-1]
+	steps = np.flatnonzero(recall[1:] != recall[:-1])
+	return float(np.sum((recall[steps + 1] - recall[steps]) * precision[steps + 1]))
+
+# precision, recall and error counts for every threshold, from the matched detections
+def sweepThresholds(matches, labels, thresholds, imageCount):
+	sweep = []
+	for threshold in thresholds:
+		perClass = {}
+		totalTp, totalFp, totalFn = 0, 0, 0
+		for labelIndex, (confidences, truePositives, groundTruthCount) in matches.items():
+			kept = int(np.sum(confidences > threshold))
+			tp = int(np.sum(truePositives[:kept]))
+			fp = kept - tp
+			fn = groundTruthCount - tp
+			totalTp, totalFp, totalFn = totalTp + tp, totalFp + fp, totalFn + fn
+			perClass[labels[labelIndex]] = {"precision": tp / kept if kept else None,\
+				"recall": tp / groundTruthCount if groundTruthCount else None, "tp": tp, "fp": fp, "fn": fn}
+		precision = totalTp / (totalTp + totalFp) if totalTp + totalFp else None
+		recall = totalTp / (totalTp + totalFn) if totalTp + totalFn else None
+		f1 = 2 * precision * recall / (precision + recall) if precision and recall else 0.0
+		# false positives send the robot after ghosts, missed objects cost it extra scans
+		sweep.append({"threshold": threshold, "precision": precision, "recall": recall, "f1": f1,\
+			"falsePositivesPerImage": totalFp / imageCount, "missedPerImage": totalFn / imageCount, "classes": perClass})
+	return sweep
+
+# run the whole evaluation, returns the report as a dictionary
+def evaluate(directory, protoPath, modelPath, labels, sizes, thresholds, workers, iouThreshold, tiled=False):
+	dataset = loadDataset(directory, labels)
+	if not dataset:
+		raise ValueError("no annotated images found in " + directory)
+	# check before starting the workers, or every one of them fails on its first image
+	settings = readGraphSettings(protoPath)
+	if settings and any(not size == settings["inputSize"] for size in sizes):
+		raise ValueError("{0} was optimized for {1}x{1} input and can't be evaluated at other sizes, use --sizes {1}"\
+			" or the original graph".format(protoPath, settings["inputSize"]))
+	report = {"model": modelPath, "graph": protoPath, "images": len(dataset), "iouThreshold": iouThreshold, "tiled": tiled, "sizes": []}
+	floor = min(thresholds)
+	with Pool(workers, initWorker, (protoPath, modelPath, labels, floor, tiled)) as pool:
+		# give the workers a first, untimed forward pass, opencv is slow on its first one
+		pool.map(detectImage, [(next(iter(dataset)), sizes[0])] * workers, chunksize=1)
+		for inputSize in sizes:
+			detections = {}
+			forwardSeconds = []
+			tiledCount = 0
+			start = time.perf_counter()
+			for path, size, rows, seconds, usedTiles in pool.imap_unordered(detectImage, [(path, inputSize) for path in dataset], chunksize=4):
+				detections[path] = rows
+				forwardSeconds.append(seconds)
+				tiledCount += usedTiles
+			wallSeconds = time.perf_counter() - start
+			matches = matchDetections(detections, dataset, labels, iouThreshold)
+			averagePrecisions = {labels[i]: averagePrecision(truePositives, count) for i, (c, truePositives, count) in matches.items()}
+			scored = [ap for ap in averagePrecisions.values() if not ap == None]
+			report["sizes"].append({"inputSize": inputSize,\
+				"imagesPerSecond": len(dataset) / wallSeconds, # across all workers
+				"meanForwardSeconds": float(np.mean(forwardSeconds)), # one image on one opencv thread, including any tiled pass
+				"tiledImages": tiledCount,\
+				"mAP": float(np.mean(scored)) if scored else None,\
+				"averagePrecision": averagePrecisions,\
+				"thresholds": sweepThresholds(matches, labels, thresholds, len(dataset))})
+	return report
+
+# turn a number that may be missing into text for the report
+def formatValue(value, pattern="{:.3f}"):
+	if value == None:
+		return "-"
+	return pattern.format(value)
+
+# write the report as json, and as a text summary for reading
+def writeReport(report, outputPrefix, currentThreshold):
+	with open(outputPrefix + ".json", "w") as jsonFile:
+		json.dump(report, jsonFile, indent=2)
+	lines = ["model {}, graph {}, {} images, matched at IoU {}".format(report["model"], report["graph"], report["images"], report["iouThreshold"])]
+	if report["tiled"]:
+		lines.append("tiled second pass on, used when nothing passes a confidence of {}".format(confidenceErrorMargin))
+	else:
+		lines.append("whole frame only, the tiled second pass was not evaluated (run with --tiled)")
+	for result in report["sizes"]:
+		lines.append("")
+		lines.append("input {0}x{0}: mAP {1}, {2:.2f} images/s over all workers, {3:.0f} ms per image on one thread".format(\
+			result["inputSize"], formatValue(result["mAP"]), result["imagesPerSecond"], result["meanForwardSeconds"] * 1000))
+		if report["tiled"]:
+			lines.append("  tiled pass used on {} of {} images".format(result["tiledImages"], report["images"]))
+		lines.append("  AP " + ", ".join(label + " " + formatValue(ap) for label, ap in result["averagePrecision"].items()))
+		lines.append("  threshold  precision  recall  f1     fp/image  missed/image")
+		for row in result["thresholds"]:
+			marker = " <- current" if abs(row["threshold"] - currentThreshold) < 1e-9 else ""
+			lines.append("  {:<9.2f}  {:<9}  {:<6}  {:<5}  {:<8.2f}  {:.2f}{}".format(row["threshold"], formatValue(row["precision"]),\
+				formatValue(row["recall"]), formatValue(row["f1"]), row["falsePositivesPerImage"], row["missedPerImage"], marker))
+		best = max(result["thresholds"], key=lambda row: row["f1"])
+		lines.append("  best f1 at threshold {:.2f}: ".format(best["threshold"]) + ", ".join(label + " p " + formatValue(c["precision"]) +\
+			" r " + formatValue(c["recall"]) for label, c in best["classes"].items()))
+	text = "\n".join(lines)
+	with open(outputPrefix + ".txt", "w") as textFile:
+		textFile.write(text + "\n")
+	return text
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Evaluate the SSD model offline on annotated images.")
+	parser.add_argument("directory", help="directory of images with Pascal VOC xml annotations")
+	parser.add_argument("--proto", default=protoPath)
+	parser.add_argument("--model", default=modelPath)
+	parser.add_argument("--sizes", type=int, nargs="+", default=[300], help="network input sizes to try")
+	parser.add_argument("--thresholds", type=float, nargs="+", default=[round(0.05 * i, 2) for i in range(1, 20)])
+	parser.add_argument("--iou", type=float, default=0.5, help="overlap needed for a detection to count as correct")
+	parser.add_argument("--workers", type=int, default=cpu_count())
+	parser.add_argument("--tiled", action="store_true", help="give images with no detections a tiled second pass, like the robot does")
+	parser.add_argument("--output", default="evaluation", help="report file prefix, .json and .txt are written")
+	args = parser.parse_args()
+	report = evaluate(args.directory, args.proto, args.model, labels, args.sizes, sorted(args.thresholds), args.workers, args.iou, args.tiled)
+	print(writeReport(report, args.output, confidenceErrorMargin))
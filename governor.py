@@ -0,0 +1,157 @@
+# governor.py
+# This file contains the Governor class, which shares the cpu between the subsystems run by the
+# main loop in __init__.py.  Each app mode has a policy giving the rate of tensorflow inferences,
+# live camera frames and gui refreshes, the size the live feed is displayed at, and which subsystem
+# matters most in that mode.  When the cpu is overloaded, inferences take too long or the control
+# loop misses its deadlines, every other subsystem is slowed down to make room for that one.
+
+import os
+import time
+
+# policies for each app mode, rates are per second, None runs as fast as possible and 0 not at all
+# priority: the subsystem that is never slowed down in this mode ("inference", "liveCam", "gui" or "control")
+# inferenceBudget: fraction of the time the detector may be busy when it isn't the priority, None lets it
+#   run back to back, which is still slowed down with everything else when the cpu is overloaded
+modePolicies = {
+	"idle": {"priority": "gui", "inferenceRate": 0.5, "liveCamRate": 5, "guiRate": 15, "liveDisplaySize": 150, "inferenceBudget": 0.3},
+	"help": {"priority": "gui", "inferenceRate": 0, "liveCamRate": 2, "guiRate": 10, "liveDisplaySize": 150, "inferenceBudget": 0.3},
+	"teleop": {"priority": "liveCam", "inferenceRate": 0.5, "liveCamRate": 15, "guiRate": 30, "liveDisplaySize": 300, "inferenceBudget": 0.3},
+	"search": {"priority": "control", "inferenceRate": None, "liveCamRate": 2, "guiRate": 10, "liveDisplaySize": 150, "inferenceBudget": None},
+	"retrieve": {"priority": "inference", "inferenceRate": None, "liveCamRate": 5, "guiRate": 15, "liveDisplaySize": 300, "inferenceBudget": None},
+	"findcrocs": {"priority": "inference", "inferenceRate": None, "liveCamRate": 5, "guiRate": 15, "liveDisplaySize": 300, "inferenceBudget": None},
+	"finddoor": {"priority": "inference", "inferenceRate": None, "liveCamRate": 5, "guiRate": 15, "liveDisplaySize": 300, "inferenceBudget": None},
+}
+
+# class to decide when each subsystem in the main loop should run
+class Governor(object):
+	# constructor, takes the app (for its mode), the robot (for its control loop) and the live camera
+	def __init__(self, videoDisplay, robot, liveCamera, policies=modePolicies):
+		self.videoDisplay = videoDisplay
+		self.robot = robot
+		self.liveCamera = liveCamera
+		self.policies = policies
+		self.highLoad = 0.9 # slow down the other subsystems above this cpu load
+		self.lowLoad = 0.7 # and let them speed back up below it
+		self.maxJitterMissRate = 0.1 # fraction of missed control deadlines treated as overload
+		self.minScale = 0.2 # the furthest a subsystem can be slowed down
+		self.measurePeriod = 1 # seconds between load measurements
+		self.scale = 1 # how fast the subsystems other than the priority run, from minScale to 1
+		self.cpuLoad = 0
+		self.inferenceSeconds = 0 # smoothed time taken by one inference
+		self.inferenceStartTime = None
+		self.lastRun = {"inference": 0, "liveCam": 0, "gui": 0}
+		self.lastMeasureTime = 0
+		self.lastCpuTimes = None
+		self.mode = None
+
+	# the policy for the current app mode
+	def policy(self):
+		return self.policies.get(self.videoDisplay.mode, self.policies["idle"])
+
+	# fraction of the cpu in use since the last call, from /proc/stat where it exists
+	def readCpuLoad(self):
+		try:
+			with open("/proc/stat") as stat:
+				times = [int(value) for value in stat.readline().split()[1:]]
+		except (IOError, ValueError):
+			return min(1, os.getloadavg()[0] / os.cpu_count())
+		idle = times[3] + times[4] # idle and iowait
+		total = sum(times)
+		load = self.cpuLoad
+		if self.lastCpuTimes and total > self.lastCpuTimes[1]:
+			load = 1 - (idle - self.lastCpuTimes[0]) / (total - self.lastCpuTimes[1])
+		self.lastCpuTimes = (idle, total)
+		return load
+
+	# fraction of recent control loop deadlines that were missed, 0 if no control loop is running
+	def controlMissRate(self):
+		controlLoop = self.robot.engine.controlLoop
+		if controlLoop == None:
+			return 0
+		recentMisses = list(controlLoop.recentMisses)
+		if not recentMisses:
+			return 0
+		return sum(recentMisses) / len(recentMisses)
+
+	# measure the load and adjust how fast the subsystems run, call this every main loop iteration
+	def update(self, now=None):
+		if now == None:
+			now = time.monotonic()
+		policy = self.policy()
+		if not self.videoDisplay.mode == self.mode: # start each mode at full speed
+			self.mode = self.videoDisplay.mode
+			self.scale = 1
+			self.liveCamera.setRate(policy["liveCamRate"])
+		if now - self.lastMeasureTime < self.measurePeriod:
+			return
+		self.lastMeasureTime = now
+		self.cpuLoad = self.readCpuLoad()
+		if self.cpuLoad > self.highLoad or self.controlMissRate() > self.maxJitterMissRate:
+			self.scale = max(self.minScale, self.scale * 0.8)
+		elif self.cpuLoad < self.lowLoad:
+			self.scale = min(1, self.scale * 1.25)
+		if policy["priority"] == "liveCam" or policy["liveCamRate"] == None:
+			self.liveCamera.setRate(policy["liveCamRate"])
+		else:
+			self.liveCamera.setRate(policy["liveCamRate"] * self.scale)
+
+	# the rate a subsystem should run at right now, None for as fast as possible
+	def rate(self, name):
+		policy = self.policy()
+		rate = policy[name + "Rate"]
+		if name == "inference" and self.inferenceSeconds > 0:
+			budget = policy["inferenceBudget"]
+			if budget == None and not policy["priority"] == name:
+				budget = 1 # back to back, but as a rate so that it can be scaled down
+			if budget:
+				# never keep the detector busy for more than its share of the time
+				budgetRate = budget / self.inferenceSeconds
+				rate = budgetRate if rate == None else min(rate, budgetRate)
+		if rate and not policy["priority"] == name:
+			rate *= self.scale
+		return rate
+
+	# returns True, and marks it as run, if a subsystem is due to run now
+	def ready(self, name, now=None):
+		if now == None:
+			now = time.monotonic()
+		rate = self.rate(name)
+		if rate == 0:
+			return False
+		if rate == None or now - self.lastRun[name] >= 1 / rate:
+			self.lastRun[name] = now
+			return True
+		return False
+
+	# seconds until the next subsystem with a set rate is due, the main loop can sleep this long
+	def idleTime(self, now=None):
+		if now == None:
+			now = time.monotonic()
+		waits = [0.02] # keep checking on the detector and the robot at least this often
+		for name in self.lastRun:
+			rate = self.rate(name)
+			if rate:
+				waits.append(1 / rate - (now - self.lastRun[name]))
+		return max(0, min(waits))
+
+	# the size to display the live camera feed at
+	def liveDisplaySize(self):
+		policy = self.policy()
+		if self.scale < 0.5 and not policy["priority"] == "liveCam":
+			return policy["liveDisplaySize"] // 2
+		return policy["liveDisplaySize"]
+
+	# call when an inference starts
+	def inferenceStarted(self):
+		self.inferenceStartTime = time.monotonic()
+
+	# call when an inference has finished, keeps a smoothed measurement of how long they take
+	def inferenceFinished(self):
+		if self.inferenceStartTime == None:
+			return
+		seconds = time.monotonic() - self.inferenceStartTime
+		self.inferenceStartTime = None
+		if self.inferenceSeconds == 0:
+			self.inferenceSeconds = seconds
+		else:
+			self.inferenceSeconds = 0.8 * self.inferenceSeconds + 0.2 * seconds
@@ -1,40 +1,316 @@
 # livecam.py
-# This file contains the code for using the picamera as a live camera stream
-# It also defines a thread for the camera, since it runs too slowly for the main loop
+# This file contains the code for using the picamera as a live camera stream.
+# The camera streams continuously from its video port into a ring of preallocated buffers on
+# its own thread, and the main loop picks up the latest frame whenever it wants to draw.
+# A video file or synthetic source can stand in for the picamera when running off the robot.
+# Run this file directly to compare the stream against capturing one still per thread.
 
-from picamera.array import PiRGBArray
-from picamera import PiCamera
+import argparse
+import threading
+import time
+from collections import deque
+import numpy as np
 import cv2
 from PIL import Image, ImageTk
-import threading
+try:
+	from picamera.array import PiRGBArray
+	from picamera import PiCamera
+except ImportError: # not on the robot, only the file and synthetic sources can be used
+	PiCamera = None
+
+# ring of preallocated frame buffers, written by one capture thread and read by any thread
+class FrameRing(object):
+	# constructor, takes the frame size and the number of buffers
+	def __init__(self, width, height, size=3):
+		self.buffers = [np.zeros((height, width, 3), dtype=np.uint8) for i in range(size)]
+		self.timestamps = [0.0] * size
+		self.sequence = 0 # number of frames written so far, the latest is in buffers[(sequence - 1) % size]
+		self.recentTimes = deque(maxlen=30) # timestamps of recent frames, used to measure fps
+		self.minInterval = 0 # frames arriving sooner than this after the last one are dropped
+		self.lastPublish = 0
+		self.newFrame = threading.Condition()
+
+	# returns True if enough time has passed since the last frame for another to be kept
+	def wants(self):
+		return time.monotonic() - self.lastPublish >= self.minInterval
+
+	# seconds until the ring will keep another frame
+	def timeUntilWanted(self):
+		return max(0, self.minInterval - (time.monotonic() - self.lastPublish))
+
+	# returns the buffer the next frame should be written into
+	def nextBuffer(self):
+		return self.buffers[self.sequence % len(self.buffers)]
+
+	# publish the buffer returned by nextBuffer() once it has been filled
+	def publish(self, timestamp=None):
+		if timestamp == None:
+			timestamp = time.monotonic()
+		with self.newFrame:
+			self.timestamps[self.sequence % len(self.buffers)] = timestamp
+			self.sequence += 1
+			self.lastPublish = timestamp
+			self.recentTimes.append(timestamp)
+			self.newFrame.notify_all()
+
+	# returns the latest frame, its timestamp and its sequence number without copying
+	# the frame is only valid until len(buffers) - 1 newer frames have been written
+	def latest(self):
+		sequence = self.sequence
+		if sequence == 0:
+			return None, 0.0, 0
+		i = (sequence - 1) % len(self.buffers)
+		return self.buffers[i], self.timestamps[i], sequence
+
+	# frames per second over the recent frames
+	def fps(self):
+		recentTimes = list(self.recentTimes)
+		if len(recentTimes) < 2 or recentTimes[-1] == recentTimes[0]:
+			return 0.0
+		return (len(recentTimes) - 1) / (recentTimes[-1] - recentTimes[0])
+
+	# wait until a frame newer than the given sequence number exists, returns False on timeout
+	def waitForFrame(self, sequence=0, timeout=None):
+		with self.newFrame:
+			return self.newFrame.wait_for(lambda: self.sequence > sequence, timeout)
 
-# thread for the camera to run in the background
-class piCamThread(threading.Thread):
-	# constructor, takes piCam as input
-	def __init__(self, camera):
-		super().__init__()
-		self.camera = camera
-	# thread runs this code
-	def run(self):
-		self.camera.takeImage()
-
-# class for the picamera hardware control
-class piCam(object):
+# writes raw rgb frames from the picamera video port straight into a FrameRing
+class RingOutput(object):
+	# constructor, takes the ring and the resolution the camera was asked for
+	def __init__(self, ring, width, height):
+		self.ring = ring
+		self.width = width
+		self.height = height
+		# the camera pads raw frames to a multiple of 32 pixels wide and 16 pixels high
+		self.paddedWidth = (width + 31) // 32 * 32
+		self.paddedHeight = (height + 15) // 16 * 16
+		self.threadNamed = False
+
+	# the camera calls this once per frame
+	def write(self, data):
+		if not self.threadNamed: # the camera calls from its own thread, name it once for the profiler
+			threading.current_thread().name = "livecam"
+			self.threadNamed = True
+		if not self.ring.wants():
+			return len(data)
+		frame = np.frombuffer(data, dtype=np.uint8).reshape((self.paddedHeight, self.paddedWidth, 3))
+		np.copyto(self.ring.nextBuffer(), frame[:self.height, :self.width])
+		self.ring.publish()
+		return len(data)
+
+	# the camera calls this when recording stops
+	def flush(self):
+		pass
+
+# source for the picamera hardware
+class PiCameraSource(object):
 	# constructor, intialize the camera
-	def __init__(self):
+	# the camera is mounted upside down, so it rotates frames itself rather than flipping them afterwards
+	def __init__(self, width=320, height=240, framerate=30, rotate=True):
+		if PiCamera == None:
+			raise RuntimeError("the picamera module is not installed, use FileSource or SyntheticSource instead")
 		self.camera = PiCamera()
+		self.width = width
+		self.height = height
+		self.framerate = framerate
+		self.rotate = rotate
 		self.rawData = PiRGBArray(self.camera)
-		self.image = None
-		self.imageSize = 300
-		self.finishedImage = None
-	
-	# take a frame
-	def takeImage(self):
+
+	# start streaming from the video port into the ring
+	def start(self, ring):
+		self.camera.resolution = (self.width, self.height)
+		self.camera.framerate = self.framerate
+		self.camera.rotation = 180 if self.rotate else 0
+		self.camera.start_recording(RingOutput(ring, self.width, self.height), format="rgb")
+
+	# stop streaming
+	def stop(self):
+		self.camera.stop_recording()
+
+	# take a single still from the still port and flip it in software, this is how frames used to be taken
+	def captureStill(self):
+		self.camera.rotation = 0
 		self.rawData.truncate(0)
 		self.camera.capture(self.rawData, format="bgr")
-		self.image = self.rawData.array
-		self.image = cv2.flip(self.image, -1)
+		image = self.rawData.array
+		if self.rotate:
+			image = cv2.flip(image, -1)
+		return image
+
+# source that plays a video file (or image sequence such as frame%03d.jpg) in a loop
+class FileSource(object):
+	# constructor, takes the path, the rate to play back at (None for as fast as possible) and output size
+	def __init__(self, path, width=320, height=240, framerate=30, rotate=False):
+		self.path = path
+		self.width = width
+		self.height = height
+		self.framerate = framerate
+		self.rotate = rotate
+		self.video = None
+		self.stopFlag = False
+		self.thread = None
+
+	# read the next frame as bgr, going back to the start at the end of the file
+	def readFrame(self):
+		if self.video == None:
+			self.video = cv2.VideoCapture(self.path)
+		success, frame = self.video.read()
+		if not success:
+			self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+			success, frame = self.video.read()
+			if not success:
+				raise IOError("could not read frames from " + self.path)
+		return frame
+
+	# start playing frames into the ring on a background thread
+	def start(self, ring):
+		self.stopFlag = False
+		self.thread = threading.Thread(target=self.run, args=(ring,), name="livecam", daemon=True)
+		self.thread.start()
+
+	# stop playing
+	def stop(self):
+		self.stopFlag = True
+		self.thread.join()
+
+	# thread runs this code, converts each frame into the next ring buffer
+	def run(self, ring):
+		scratch = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+		rgb = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+		nextTime = time.monotonic()
+		while not self.stopFlag:
+			frame = self.readFrame()
+			if ring.wants():
+				cv2.resize(frame, (self.width, self.height), dst=scratch)
+				if self.rotate:
+					cv2.cvtColor(scratch, cv2.COLOR_BGR2RGB, dst=rgb)
+					cv2.flip(rgb, -1, dst=ring.nextBuffer())
+				else:
+					cv2.cvtColor(scratch, cv2.COLOR_BGR2RGB, dst=ring.nextBuffer())
+				ring.publish()
+			# keep to the frame rate whether or not the ring kept the frame, so dropping frames saves cpu
+			if self.framerate:
+				nextTime += 1 / self.framerate
+				time.sleep(max(0, nextTime - time.monotonic()))
+			else: # as fast as possible, but there is no point reading frames the ring will drop
+				time.sleep(ring.timeUntilWanted())
+
+	# read a single frame, flipping it in software like the picamera used to
+	def captureStill(self):
+		image = cv2.resize(self.readFrame(), (self.width, self.height))
+		if self.rotate:
+			image = cv2.flip(image, -1)
+		return image
+
+# source that generates a moving test pattern, for running without any camera at all
+class SyntheticSource(FileSource):
+	# constructor, takes the output size and the rate to generate at (None for as fast as possible)
+	def __init__(self, width=320, height=240, framerate=30, rotate=False):
+		super().__init__(None, width, height, framerate, rotate)
+		self.frameNumber = 0
+		self.gradient = np.tile(np.linspace(0, 255, width, dtype=np.uint8), (height, 1))
+
+	# returns the next bgr frame of the pattern, a gradient with a bar sweeping across it
+	def readFrame(self):
+		frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+		frame[:, :, 0] = self.gradient
+		frame[:, :, 1] = self.gradient[:, ::-1]
+		frame[:, :, 2] = 128
+		x = self.frameNumber * 4 % self.width
+		frame[:, x:x + 8] = 255
+		self.frameNumber += 1
+		return frame
+
+# class for the live camera, keeps the source streaming and hands out the latest frame
+class LiveCamera(object):
+	# constructor, takes a source (PiCameraSource, FileSource or SyntheticSource)
+	def __init__(self, source, ringSize=3):
+		self.source = source
+		self.ring = FrameRing(source.width, source.height, ringSize)
+		self.imageSize = 300
+		self.displayBuffers = {} # one preallocated buffer per display size
+
+	# start streaming
+	def start(self):
+		self.source.start(self.ring)
+
+	# stop streaming
+	def stop(self):
+		self.source.stop()
+
+	# the number of the latest frame, changes whenever a new frame arrives
+	@property
+	def sequence(self):
+		return self.ring.sequence
+
+	# returns the latest rgb frame and its timestamp (time.monotonic()), without copying
+	def latestFrame(self):
+		frame, timestamp, sequence = self.ring.latest()
+		return frame, timestamp
+
+	# wait for the first frame to arrive
+	def waitForFrame(self, timeout=None):
+		return self.ring.waitForFrame(0, timeout)
+
+	# frames per second achieved by the stream
+	def fps(self):
+		return self.ring.fps()
+
+	# keep at most this many frames per second, None or 0 keeps every frame
+	def setRate(self, rate):
+		self.ring.minInterval = 1 / rate if rate else 0
+
+	# convert the image to a tkinter image for viewing, at the given size or the full image size
+	def getCurrTkImage(self, size=None):
+		if size == None:
+			size = self.imageSize
+		if not size in self.displayBuffers:
+			self.displayBuffers[size] = np.zeros((size, size, 3), dtype=np.uint8)
+		frame, timestamp = self.latestFrame()
+		cv2.resize(frame, (size, size), dst=self.displayBuffers[size])
+		return ImageTk.PhotoImage(Image.fromarray(self.displayBuffers[size]))
+
+# measure the frame rate of capturing one still per short-lived thread, the old way of taking frames
+def measureStillCapture(source, seconds):
+	count = 0
+	start = time.monotonic()
+	while time.monotonic() - start < seconds:
+		thread = threading.Thread(target=source.captureStill)
+		thread.start()
+		thread.join()
+		count += 1
+	return count / (time.monotonic() - start)
+
+# measure the frame rate of the continuous stream
+def measureStream(source, seconds):
+	camera = LiveCamera(source)
+	camera.start()
+	camera.waitForFrame(5)
+	frame, start, startSequence = camera.ring.latest()
+	time.sleep(seconds)
+	frame, end, endSequence = camera.ring.latest()
+	camera.stop()
+	if end <= start:
+		return 0.0
+	return (endSequence - startSequence) / (end - start)
 
-	# convert the image to a tkinter image for viewing
-	def getCurrTkImage(self):
-		return ImageTk.PhotoImage(Image.fromarray(cv2.resize(self.image, (self.imageSize, self.imageSize))))
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Compare the live camera stream against capturing a still per thread.")
+	parser.add_argument("--source", choices=["picamera", "file", "synthetic"], default="synthetic")
+	parser.add_argument("--path", help="video file or image sequence for the file source")
+	parser.add_argument("--seconds", type=float, default=5)
+	parser.add_argument("--framerate", type=float, default=30, help="stream rate, 0 for as fast as possible")
+	args = parser.parse_args()
+	framerate = args.framerate or None
+	if args.source == "picamera":
+		source = PiCameraSource(framerate=framerate or 90)
+	elif args.source == "file":
+		source = FileSource(args.path, framerate=framerate)
+	else:
+		source = SyntheticSource(framerate=framerate)
+	stillFps = measureStillCapture(source, args.seconds)
+	streamFps = measureStream(source, args.seconds)
+	print("capture per thread: {:.1f} fps".format(stillFps))
+	print("continuous stream:  {:.1f} fps".format(streamFps))
+	if stillFps > 0:
+		print("speedup:            {:.1f}x".format(streamFps / stillFps))
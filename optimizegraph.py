@@ -0,0 +1,280 @@
+# optimizegraph.py
+# This file rewrites the text graph (graph.pbtxt) for the fixed 300x300 input the SSD always uses.
+# - the PriorBox nodes only depend on the input and feature map sizes, so their output is computed
+#   once here and stored in the graph as a constant
+# - the Preprocessor/mul and Preprocessor/sub normalization is removed from the graph, and
+#   blobFromImage does it instead while it builds the input blob
+# - the Reshape, Sigmoid, Flatten chain on the class predictions only changes shapes around the
+#   sigmoid, so the reshapes are dropped and the sigmoid is applied to the flat predictions
+# - nodes that nothing depends on any more are removed
+# The optimized graph starts with a comment line that SSD reads to set up the input blob.  Before the
+# graph is written, both graphs are run on the same images and must give the same detections, both
+# above the threshold and in the raw top rows of detection_out, and the forward pass times are reported.
+# Random images only show that the graph loads, so it is not written without real images unless forced.
+# Example: python optimizegraph.py --images testImages --output graph_optimized.pbtxt
+
+import argparse
+import os
+import time
+import numpy as np
+import cv2
+from singleshot import *
+
+# a node of the text graph, keeps its original text so everything not changed here is written back as is
+class GraphNode(object):
+	# constructor, takes the lines of one "node { ... }" block
+	def __init__(self, lines):
+		self.lines = lines
+		self.name = None
+		self.op = None
+		self.inputs = []
+		for line in lines:
+			if line.startswith("  name: "):
+				self.name = line.split('"')[1]
+			elif line.startswith("  op: "):
+				self.op = line.split('"')[1]
+			elif line.startswith("  input: "):
+				self.inputs.append(line.split('"')[1])
+
+	# the node as text, with its current inputs
+	def text(self):
+		lines = [line for line in self.lines if not line.startswith("  input: ")]
+		inputLines = ['  input: "{}"'.format(name) for name in self.inputs]
+		insertAt = 3 if len(lines) > 3 else len(lines) - 1 # after node {, name and op
+		return "\n".join(lines[:insertAt] + inputLines + lines[insertAt:])
+
+# build a Const node holding a float32 array
+def constNode(name, array):
+	array = np.ascontiguousarray(array, dtype=np.float32)
+	content = "".join("\\{:03o}".format(byte) for byte in array.tobytes())
+	dims = "\n".join("          dim {{\n            size: {}\n          }}".format(size) for size in array.shape)
+	text = """node {{
+  name: "{}"
+  op: "Const"
+  attr {{
+    key: "dtype"
+    value {{
+      type: DT_FLOAT
+    }}
+  }}
+  attr {{
+    key: "value"
+    value {{
+      tensor {{
+        dtype: DT_FLOAT
+        tensor_shape {{
+{}
+        }}
+        tensor_content: "{}"
+      }}
+    }}
+  }}
+}}""".format(name, dims, content)
+	return GraphNode(text.split("\n"))
+
+# read a text graph into a list of nodes, in order
+def readGraph(path):
+	nodes = []
+	block = None
+	with open(path) as graphFile:
+		for line in graphFile.read().split("\n"):
+			if line.startswith("#"):
+				continue
+			if line == "node {":
+				block = [line]
+			elif not block == None:
+				block.append(line)
+				if line == "}":
+					nodes.append(GraphNode(block))
+					block = None
+	return nodes
+
+# write nodes as a text graph, after a header comment
+def writeGraph(nodes, path, header):
+	with open(path, "w") as graphFile:
+		graphFile.write(header + "\n")
+		graphFile.write("\n".join(node.text() for node in nodes) + "\n")
+
+# point every input that used to come from one node at another
+def replaceInput(nodes, oldName, newName):
+	for node in nodes:
+		node.inputs = [newName if name == oldName else name for name in node.inputs]
+
+# keep only the nodes the output depends on
+def removeDeadNodes(nodes, outputName):
+	byName = {node.name: node for node in nodes}
+	needed = set()
+	pending = [outputName]
+	while pending:
+		name = pending.pop()
+		if name in needed or not name in byName:
+			continue
+		needed.add(name)
+		pending.extend(inputName.split(":")[0] for inputName in byName[name].inputs)
+	return [node for node in nodes if node.name in needed]
+
+# compute the prior boxes with the original graph and store them as a constant
+def foldPriorBoxes(nodes, net, inputSize):
+	blob = np.zeros((1, 3, inputSize, inputSize), dtype=np.float32)
+	net.setInput(blob)
+	priors = net.forward("PriorBox/concat")
+	priorsName = "PriorBox/concat/priors"
+	for node in nodes:
+		if node.name == "PriorBox/concat":
+			# keep the concat node so detection_out still reads from a layer, with the constant as its only input
+			node.inputs = [priorsName, node.inputs[-1]]
+	nodes.insert(0, constNode(priorsName, priors))
+	return priors.shape
+
+# remove the normalization nodes, the input blob is normalized instead
+def foldPreprocessing(nodes):
+	byName = {node.name: node for node in nodes}
+	mul = byName.get("Preprocessor/mul")
+	sub = byName.get("Preprocessor/sub")
+	if mul == None or sub == None or not sub.inputs[0] == mul.name:
+		raise ValueError("the graph has no Preprocessor/mul, Preprocessor/sub pair to fold")
+	replaceInput(nodes, sub.name, mul.inputs[0])
+
+# drop a Reshape -> elementwise -> Flatten chain whose input is already flat
+def foldShapeOps(nodes):
+	byName = {node.name: node for node in nodes}
+	folded = 0
+	for flatten in nodes:
+		if not flatten.op == "Flatten":
+			continue
+		elementwise = byName.get(flatten.inputs[0])
+		if elementwise == None or not elementwise.op in ("Sigmoid", "Relu", "Relu6", "Tanh"):
+			continue
+		reshape = byName.get(elementwise.inputs[0])
+		if reshape == None or not reshape.op == "Reshape":
+			continue
+		source = byName.get(reshape.inputs[0])
+		# a concat of flattened tensors along the last axis is flat already
+		if source == None or not source.op == "ConcatV2" or not all(byName[name].op == "Flatten" for name in source.inputs[:-1]):
+			continue
+		elementwise.inputs[0] = reshape.inputs[0]
+		replaceInput(nodes, flatten.name, elementwise.name)
+		folded += 1
+	return folded
+
+# run a net on an image, returns the detection_out rows and the time taken
+def runNet(net, image, inputSize, scale=1.0, mean=0.0):
+	net.setInput(cv2.dnn.blobFromImage(image, scalefactor=scale, size=(inputSize, inputSize), mean=(mean, mean, mean), swapRB=True, crop=False))
+	start = time.perf_counter()
+	detectedObjects = net.forward()[0, 0]
+	return detectedObjects, time.perf_counter() - start
+
+# returns the first row of detectedObjects above the threshold with no close match in others
+# rows within the confidence tolerance of the threshold may fall either side of it, so they are skipped
+def findUnmatched(detectedObjects, others, threshold, confidenceTolerance, boxTolerance):
+	others = others[others[:, 2] > threshold - confidenceTolerance]
+	for row in detectedObjects[detectedObjects[:, 2] > threshold + confidenceTolerance]:
+		matches = (others[:, 1] == row[1]) & (np.abs(others[:, 2] - row[2]) <= confidenceTolerance) &\
+			(np.abs(others[:, 3:7] - row[3:7]).max(axis=1) <= boxTolerance)
+		if not matches.any():
+			return row
+	return None
+
+# returns a description of a detection that differs between the two graphs, or None if they match
+def compareDetections(original, optimized, threshold, confidenceTolerance, boxTolerance):
+	row = findUnmatched(original, optimized, threshold, confidenceTolerance, boxTolerance)
+	if not row is None:
+		return "label {} at {:.3f} confidence is missing from the optimized graph".format(int(row[1]), row[2])
+	row = findUnmatched(optimized, original, threshold, confidenceTolerance, boxTolerance)
+	if not row is None:
+		return "label {} at {:.3f} confidence is new in the optimized graph".format(int(row[1]), row[2])
+	return None
+
+# returns a description of a difference in the most confident rows of the two graphs, or None if they match
+# unlike compareDetections this looks below any threshold, where a change in the graph shows up first
+def compareTopRows(original, optimized, topK, confidenceTolerance, boxTolerance):
+	original = original[np.argsort(-original[:, 2], kind="stable")[:topK]]
+	optimized = optimized[np.argsort(-optimized[:, 2], kind="stable")[:topK]]
+	if not len(original) == len(optimized):
+		return "{} rows from the original graph, {} from the optimized graph".format(len(original), len(optimized))
+	if len(original) == 0:
+		return None
+	# the confidences are sorted, so they can be compared one to one even where boxes swap places
+	worst = np.abs(original[:, 2] - optimized[:, 2]).max()
+	if worst > confidenceTolerance:
+		return "top {} confidences differ by up to {:.4f}".format(len(original), worst)
+	# match every row above the weakest kept one, rows near the cut off may have been swapped with ones just below it
+	difference = compareDetections(original, optimized, original[-1, 2], confidenceTolerance, boxTolerance)
+	if difference:
+		return "top {} rows: {}".format(len(original), difference)
+	return None
+
+# load the test images, or make some if no directory was given
+def loadImages(directory, count):
+	if directory:
+		paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory))\
+			if os.path.splitext(name)[1].lower() in (".jpg", ".jpeg", ".png", ".bmp")]
+		return [cv2.imread(path) for path in paths[:count]]
+	generator = np.random.RandomState(0)
+	return [generator.randint(0, 256, (480, 640, 3)).astype(np.uint8) for i in range(count)]
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Optimize the SSD text graph for a fixed input size.")
+	parser.add_argument("--proto", default=protoPath)
+	parser.add_argument("--model", default=modelPath)
+	parser.add_argument("--output", default=optimizedProtoPath)
+	parser.add_argument("--size", type=int, default=300, help="the fixed input size")
+	parser.add_argument("--scale", type=float, default=2 / 255, help="the factor in Preprocessor/mul")
+	parser.add_argument("--offset", type=float, default=1.0, help="the value subtracted in Preprocessor/sub")
+	parser.add_argument("--images", help="directory of images to check the graphs with, random images if not given (needs --force to write)")
+	parser.add_argument("--count", type=int, default=20, help="number of images to check and time")
+	parser.add_argument("--threshold", type=float, default=0.05, help="detections below this confidence are not compared")
+	parser.add_argument("--topk", type=int, default=100, help="number of raw detection_out rows compared regardless of confidence")
+	parser.add_argument("--force", action="store_true", help="write the graph even if the detections differ")
+	args = parser.parse_args()
+
+	originalNet = cv2.dnn.readNetFromTensorflow(args.model, args.proto)
+	nodes = readGraph(args.proto)
+	nodeCount = len(nodes)
+	priorShape = foldPriorBoxes(nodes, originalNet, args.size)
+	foldPreprocessing(nodes)
+	foldedShapeOps = foldShapeOps(nodes)
+	nodes = removeDeadNodes(nodes, "detection_out")
+	# (x * scale - offset) is the same as blobFromImage's (x - mean) * scale
+	mean = args.offset / args.scale
+	header = "# optimized inputSize={} scale={!r} mean={!r}".format(args.size, args.scale, mean)
+	print("{} nodes down to {}: prior boxes {} folded, normalization folded, {} shape-only chains removed".format(\
+		nodeCount, len(nodes), priorShape, foldedShapeOps))
+
+	candidatePath = args.output + ".candidate"
+	writeGraph(nodes, candidatePath, header)
+	try:
+		optimizedNet = cv2.dnn.readNetFromTensorflow(args.model, candidatePath)
+	except cv2.error as error:
+		os.remove(candidatePath)
+		raise SystemExit("opencv could not load the optimized graph: " + str(error))
+
+	images = loadImages(args.images, args.count)
+	# warm both nets up, the first forward pass is much slower than the rest
+	runNet(originalNet, images[0], args.size)
+	runNet(optimizedNet, images[0], args.size, args.scale, mean)
+	originalSeconds, optimizedSeconds = [], []
+	mismatches = 0
+	for i, image in enumerate(images):
+		original, seconds = runNet(originalNet, image, args.size)
+		originalSeconds.append(seconds)
+		optimized, seconds = runNet(optimizedNet, image, args.size, args.scale, mean)
+		optimizedSeconds.append(seconds)
+		difference = compareDetections(original, optimized, args.threshold, 1e-3, 1e-3) or\
+			compareTopRows(original, optimized, args.topk, 1e-3, 1e-3)
+		if difference:
+			mismatches += 1
+			print("image {}: {}".format(i, difference))
+	originalMs = np.mean(originalSeconds) * 1000
+	optimizedMs = np.mean(optimizedSeconds) * 1000
+	print("forward pass: {:.1f} ms original, {:.1f} ms optimized, {:.1f} ms ({:.1%}) saved".format(\
+		originalMs, optimizedMs, originalMs - optimizedMs, (originalMs - optimizedMs) / originalMs))
+	if mismatches and not args.force:
+		os.remove(candidatePath)
+		raise SystemExit("detections differ on {} of {} images, the optimized graph was not written".format(mismatches, len(images)))
+	if not args.images and not args.force:
+		os.remove(candidatePath)
+		raise SystemExit("only random images were checked, which detect nothing, so the optimized graph was not written."\
+			" Check it with --images, or write it anyway with --force")
+	os.replace(candidatePath, args.output)
+	print("detections match on {} of {} images, wrote {}".format(len(images) - mismatches, len(images), args.output))
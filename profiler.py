@@ -0,0 +1,175 @@
+# profiler.py
+# This file contains the SamplingProfiler class, which finds out where the robot's threads spend
+# their time.  It samples every thread's stack at a fixed rate from a background thread, tags each
+# stack with the role of its thread (detector, mission, live camera, gui), and writes collapsed
+# stacks that flamegraph.pl or speedscope turn into flame graphs, plus a per-thread summary.
+# It can be started and stopped at any time, including in the middle of a mission.
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# thread names and the role they are reported under
+threadRoles = {
+	"MainThread": "gui",
+	"detector": "detector",
+	"mission": "mission",
+	"livecam": "livecam",
+}
+
+# class for the sampling profiler
+class SamplingProfiler(object):
+	# constructor, takes the samples per second and the directory to write results to
+	def __init__(self, rate=100, outputDirectory="profiles", maxDepth=64):
+		self.rate = rate
+		self.outputDirectory = outputDirectory
+		self.maxDepth = maxDepth
+		self.cpuPeriod = 0.2 # seconds between reads of each thread's cpu time
+		self.thread = None
+		self.stopFlag = False
+		self.running = False
+
+	# start sampling if stopped, stop and write the results if running
+	def toggle(self):
+		if self.running:
+			return self.stop()
+		self.start()
+
+	# start sampling
+	def start(self):
+		if self.running:
+			return
+		self.stacks = Counter() # (role, code objects from the outermost call in) -> samples
+		self.threadSamples = Counter() # role -> samples
+		self.roles = {} # thread ident -> role
+		self.liveNativeIds = {} # native id -> role for the threads alive at the last refresh
+		self.startCpu = {}
+		self.lastCpu = {} # the latest cpu reading of every thread, kept after the thread ends
+		self.samples = 0
+		self.overheadSeconds = 0
+		self.stopFlag = False
+		self.running = True
+		self.refreshRoles()
+		self.startCpu = self.readThreadCpu()
+		self.lastCpu = dict(self.startCpu)
+		self.startTime = time.monotonic()
+		self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+		self.thread.start()
+
+	# stop sampling and write the results, returns the path of the summary
+	def stop(self):
+		if not self.running:
+			return None
+		self.stopFlag = True
+		self.thread.join()
+		self.running = False
+		return self.write()
+
+	# look up the role of every live thread
+	def refreshRoles(self):
+		self.liveNativeIds = {}
+		for thread in threading.enumerate():
+			if thread.name == "profiler":
+				continue
+			role = threadRoles.get(thread.name, thread.name)
+			self.roles[thread.ident] = role
+			nativeId = getattr(thread, "native_id", None)
+			if nativeId:
+				self.liveNativeIds[nativeId] = role
+
+	# cpu seconds used so far by each role's threads, from /proc where it exists
+	def readThreadCpu(self):
+		cpu = {}
+		ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+		for nativeId, role in self.liveNativeIds.items():
+			try:
+				with open("/proc/self/task/{}/stat".format(nativeId)) as stat:
+					# skip past the thread name, which can contain spaces, utime and stime are fields 14 and 15
+					fields = stat.read().rsplit(")", 1)[1].split()
+				cpu[(role, nativeId)] = (int(fields[11]) + int(fields[12])) / ticks
+			except (IOError, IndexError, ValueError):
+				pass
+		return cpu
+
+	# thread runs this code, samples every other thread's stack until stopped
+	def run(self):
+		ownIdent = threading.get_ident()
+		period = 1 / self.rate
+		nextSample = time.monotonic()
+		lastRefresh = nextSample
+		while not self.stopFlag:
+			sampleStart = time.thread_time()
+			for ident, frame in sys._current_frames().items():
+				if ident == ownIdent:
+					continue
+				role = self.roles.get(ident)
+				if role == None: # a thread started since the last refresh
+					self.refreshRoles()
+					role = self.roles.get(ident, "thread-" + str(ident))
+				codes = []
+				while frame and len(codes) < self.maxDepth:
+					codes.append(frame.f_code)
+					frame = frame.f_back
+				codes.reverse()
+				self.stacks[(role, tuple(codes))] += 1
+				self.threadSamples[role] += 1
+			self.samples += 1
+			self.overheadSeconds += time.thread_time() - sampleStart
+			nextSample += period
+			now = time.monotonic()
+			# pick up threads that started since the last refresh, and read cpu time often enough
+			# to catch the short-lived detector threads before they end
+			if now - lastRefresh > self.cpuPeriod:
+				self.refreshRoles()
+				self.lastCpu.update(self.readThreadCpu())
+				lastRefresh = now
+			if nextSample > now:
+				time.sleep(nextSample - now)
+			else:
+				nextSample = now # fell behind, skip the missed samples rather than bursting
+
+	# the name of a function in a collapsed stack
+	@staticmethod
+	def describe(code):
+		return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+	# write the collapsed stacks and the summary, returns the path of the summary
+	def write(self):
+		elapsed = time.monotonic() - self.startTime
+		self.lastCpu.update(self.readThreadCpu())
+		os.makedirs(self.outputDirectory, exist_ok=True)
+		prefix = os.path.join(self.outputDirectory, time.strftime("profile-%Y%m%d-%H%M%S"))
+		names = {}
+		collapsed = Counter()
+		selfTime = {}
+		for (role, codes), count in self.stacks.items():
+			for code in codes:
+				if not code in names:
+					names[code] = self.describe(code)
+			collapsed[";".join([role] + [names[code] for code in codes])] += count
+			if codes:
+				selfTime.setdefault(role, Counter())[names[codes[-1]]] += count
+		with open(prefix + ".collapsed", "w") as collapsedFile:
+			for stack, count in sorted(collapsed.items()):
+				collapsedFile.write("{} {}\n".format(stack, count))
+		cpu = Counter()
+		for key, seconds in self.lastCpu.items():
+			cpu[key[0]] += seconds - self.startCpu.get(key, 0)
+		lines = ["{} samples over {:.1f}s ({:.0f} per second), profiler used {:.2f}s of cpu ({:.1%})".format(self.samples,\
+			elapsed, self.samples / max(elapsed, 1e-9), self.overheadSeconds, self.overheadSeconds / max(elapsed, 1e-9)), "",\
+			"role          samples  share   cpu seconds  cpu share"]
+		totalSamples = sum(self.threadSamples.values())
+		for role, count in self.threadSamples.most_common():
+			cpuText = "{:<11.2f}  {:.1%}".format(cpu[role], cpu[role] / max(elapsed, 1e-9)) if role in cpu else "-"
+			lines.append("{:<12}  {:<7}  {:<5.1%}  {}".format(role, count, count / totalSamples, cpuText))
+		for role, counts in selfTime.items():
+			lines.append("")
+			lines.append("top functions in " + role)
+			for name, count in counts.most_common(10):
+				lines.append("  {:<6.1%} {}".format(count / self.threadSamples[role], name))
+		with open(prefix + ".txt", "w") as summaryFile:
+			summaryFile.write("\n".join(lines) + "\n")
+		print("profile written to " + prefix + ".collapsed and " + prefix + ".txt")
+		return prefix + ".txt"
@@ -0,0 +1,143 @@
+# realtime.py
+# This file contains the ControlLoop class, which paces a control loop on monotonic deadlines.
+# It keeps track of missed deadlines and jitter, and lowers a speed scale for the robot when the
+# loop can't hold its rate, so the robot moves slowly enough for the loop to keep up.
+
+import os
+import threading
+import time
+from collections import deque
+
+# class to run a loop body at a fixed rate
+class ControlLoop(object):
+	# constructor, takes the loop period in seconds
+	# priority (1 to 99, real-time) and cpu are optional and only applied where the os allows it
+	def __init__(self, period, priority=None, cpu=None):
+		self.period = period
+		self.priority = priority
+		self.cpu = cpu
+		self.binEdges = [0.5, 1, 2, 5, 10, 20, 50] # jitter histogram bin edges in milliseconds
+		self.missWindow = 50 # number of recent iterations used to decide on slowing down
+		self.slowDownRate = 0.2 # slow down if more than this fraction of recent deadlines were missed
+		self.speedUpRate = 0.05 # speed back up if fewer than this fraction were missed
+		self.minSpeedScale = 0.4
+		self.savedScheduling = None
+		self.savedAffinity = None
+		self.reset()
+
+	# clear all measurements
+	def reset(self):
+		self.histogram = [0] * (len(self.binEdges) + 1)
+		self.iterations = 0
+		self.missedDeadlines = 0
+		self.worstJitter = 0
+		self.recentMisses = deque(maxlen=self.missWindow)
+		self.speedScale = 1
+		self.sinceAdjustment = 0 # iterations since the speed scale last changed
+		self.nextDeadline = None
+
+	# raise the priority of the calling thread and pin it to a cpu, skipping whatever is not allowed
+	def applyScheduling(self):
+		applied = []
+		if not self.priority == None:
+			try:
+				self.savedScheduling = (os.sched_getscheduler(0), os.sched_getparam(0))
+				os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))
+				applied.append("SCHED_FIFO priority " + str(self.priority))
+			except (AttributeError, OSError):
+				self.savedScheduling = None
+				# real-time scheduling needs root, a better nice value might still be allowed
+				try:
+					self.savedScheduling = ("nice", os.getpriority(os.PRIO_PROCESS, threading.get_native_id()))
+					os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), -10)
+					applied.append("nice -10")
+				except (AttributeError, OSError):
+					self.savedScheduling = None
+		if not self.cpu == None:
+			try:
+				self.savedAffinity = os.sched_getaffinity(0)
+				os.sched_setaffinity(0, {self.cpu})
+				applied.append("cpu " + str(self.cpu))
+			except (AttributeError, OSError):
+				self.savedAffinity = None
+		return applied
+
+	# put the calling thread back to the scheduling it had before applyScheduling()
+	def restoreScheduling(self):
+		try:
+			if self.savedScheduling == None:
+				pass
+			elif self.savedScheduling[0] == "nice":
+				os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.savedScheduling[1])
+			else:
+				os.sched_setscheduler(0, self.savedScheduling[0], self.savedScheduling[1])
+		except (AttributeError, OSError):
+			pass
+		self.savedScheduling = None
+		# the thread may have been limited to some cpus before it was pinned, so put back exactly those
+		if not self.savedAffinity == None:
+			try:
+				os.sched_setaffinity(0, self.savedAffinity)
+			except (AttributeError, OSError):
+				pass
+		self.savedAffinity = None
+
+	# call once per iteration after the loop body, sleeps until the next deadline
+	def wait(self):
+		if self.nextDeadline == None:
+			self.nextDeadline = time.monotonic()
+		self.nextDeadline += self.period
+		now = time.monotonic()
+		if now > self.nextDeadline: # the body overran its slot
+			jitter = now - self.nextDeadline
+			missed = True
+			self.missedDeadlines += 1
+			self.nextDeadline = now # start again from now rather than rushing to catch up
+		else:
+			time.sleep(self.nextDeadline - now)
+			jitter = time.monotonic() - self.nextDeadline
+			missed = False
+		self.iterations += 1
+		self.worstJitter = max(self.worstJitter, jitter)
+		jitterMs = jitter * 1000
+		i = 0
+		while i < len(self.binEdges) and jitterMs >= self.binEdges[i]:
+			i += 1
+		self.histogram[i] += 1
+		self.recentMisses.append(missed)
+		self.updateSpeedScale()
+
+	# slow down when too many recent deadlines were missed, and speed back up once they are held
+	# the scale changes at most once per window, so one stall that stays in the window for a while
+	# only costs one step, and only overload that lasts window after window reaches the floor
+	def updateSpeedScale(self):
+		self.sinceAdjustment += 1
+		if len(self.recentMisses) < self.missWindow or self.sinceAdjustment < self.missWindow:
+			return
+		missRate = sum(self.recentMisses) / len(self.recentMisses)
+		if missRate > self.slowDownRate:
+			self.speedScale = max(self.minSpeedScale, self.speedScale * 0.8)
+			self.sinceAdjustment = 0
+		elif missRate < self.speedUpRate and self.speedScale < 1:
+			self.speedScale = min(1, self.speedScale + 0.1)
+			self.sinceAdjustment = 0
+
+	# fraction of all iterations that missed their deadline
+	def missRate(self):
+		if self.iterations == 0:
+			return 0
+		return self.missedDeadlines / self.iterations
+
+	# returns a readable summary of the measurements
+	def report(self):
+		lines = ["{} iterations at {:.0f} Hz, {} missed deadlines ({:.1%}), worst jitter {:.1f} ms, speed scale {:.2f}".format(\
+			self.iterations, 1 / self.period, self.missedDeadlines, self.missRate(), self.worstJitter * 1000, self.speedScale)]
+		lower = 0
+		for i in range(len(self.histogram)):
+			if i < len(self.binEdges):
+				label = "{:>5} - {:<5} ms".format(lower, self.binEdges[i])
+				lower = self.binEdges[i]
+			else:
+				label = "{:>5} +       ms".format(lower)
+			lines.append(label + " " + str(self.histogram[i]))
+		return "\n".join(lines)
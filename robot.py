@@ -22,9 +22,10 @@ class Robot(object):
 		self.linesensors = LineSensor()
 		self.videoDisplay = None # this must be set manually after the display has been created
 		self.detector = None # this must be set manually after the display has been created
-		self.thread = None
 		self.position = 0 # the unit is the distance covered by the robot in 1 second
 		self.accuratePosition = 0 # this is in feet, and is modified only using higher fidelity localization than odometry
+		self.engine = MissionEngine(self) # runs every autonomous stage on one thread
+		self.engine.start()
 
 	# move the robot in a given direction
 	def drive(self, direction, speed=1):
@@ -43,27 +44,26 @@ class Robot(object):
 		self.leftServo.setSpeed(0)
 		self.rightServo.setSpeed(0)
 		
-	# stop the thread running movements
-	def stopCurrentThread(self):
-		self.thread.stop()
-		self.thread.join()
+	# stop the autonomous stage that is running, if any
+	def stopCurrentStage(self):
+		self.engine.stop()
 
-	# start line following, create a new thread
+	# stop the autonomous stage and shut the mission engine down
+	def shutdown(self):
+		self.engine.shutdown()
+
+	# start line following
 	def lineFollow(self):
-		self.thread = LineFollowThread(self, self.videoDisplay, self.detector)
-		self.thread.start()
+		self.engine.begin("search")
 		
 	# retrieve the student id
 	def retrieve(self):
-		self.thread = RetrieveThread(self, self.videoDisplay, self.detector)
-		self.thread.start()
+		self.engine.begin("retrieve")
 
 	# locate the crocs and drive to them
 	def findCrocs(self):
-		self.thread = findCrocsThread(self, self.videoDisplay, self.detector)
-		self.thread.start()
+		self.engine.begin("findcrocs")
 		
 	# drive to the door
 	def findDoor(self):
-		self.thread = findDoorThread(self, self.videoDisplay, self.detector)
-		self.thread.start()
+		self.engine.begin("finddoor")
@@ -1,82 +1,56 @@
-# This file contains the generic RobotThread to define basic robot behavior revolving around
-# when tensorflow inferences are available.  Each action (thread) of the robot extends this class
-# and adds functionality to the framework, but uses the same timing.
+# This file contains the Stage class, which defines basic robot behavior revolving around
+# when tensorflow inferences are available, and the MissionEngine that runs the stages.  Each
+# step of the mission extends Stage, and the engine runs every stage on one long-lived thread
+# so detection and pose state carry over from one stage to the next.
 
 import threading
 import time
 import copy
 import math
+from realtime import *
 
-# defines basic robot mode methods, children need a run() method
+# defines basic robot stage methods, children need a runLoop() method
 
 
-class RobotThread(threading.Thread):
+class Stage(object):
     # constructor, takes robot as input
     def __init__(self, robot, videoDisplay, detector):
-        super().__init__()
         self.robot = robot
         self.videoDisplay = videoDisplay
-        self.stopFlag = False
-        self.pauseFlag = False
-        self.tfFinishedFlag = False
-        self.waitedOnce = False
         self.detector = detector
+        self.speedScale = 1  # set by the engine, lowered when the control loop can't keep up
 
     # this method is called when a new inference is available
     def tfFinished(self):
-        self.tfFinishedFlag = True
-
-    # this method changes the stop flag to true, stopping the infinite loop
-    def stop(self):
-        self.stopFlag = True
+        pass
 
-    # this method sets the pause flag to true, temporarily stopping the loop
-    def pause(self):
-        self.pauseFlag = True
-        self.waitedOnce = False
-        self.robot.stop()
+    # pick the direction to scan in, toward the side of the frame an object was last seen on
+    def scanDirection(self, name):
+        sighting = self.detector.memory.sighting(name)
+        if sighting and sighting.x < 0.5:
+            return "left"
+        return "right"
 
-    # this method sets the pause flag to false, enabling movement again
-    def resume(self):
-        self.pauseFlag = False
+    # children can override this, runs once when the stage becomes active
+    def enter(self):
+        pass
 
-    # this generically runs an infinite loop, allowing pauses and stops
-    def run(self):
-        while not self.stopFlag:  # run thread until stop flag is raised
-            if self.tfFinishedFlag:  # if tensorflow inference is available
-                self.tfFinishedFlag = False
-                if self.waitedOnce:  # if this is the second frame (frame from stopping point)
-                    self.waitedOnce = False
-                    if self.taskComplete():  # if task is finished, move on to the next one
-                        self.nextThread()
-                        return
-                    else:
-                        self.resume()
-                        self.videoDisplay.startTime = time.time()
-                else:
-                    self.waitedOnce = True
-            if self.pauseFlag:  # if the pause flag is raised, do not do anything
-                self.robot.stop()
-            else:
-                self.runLoop()  # otherwise, do the action specified by the thread
-        self.robot.stop()
+    # children can override this, runs once when the stage's guard has passed
+    def exit(self):
+        pass
 
     # children must override this, checks if the current task has finished
     def taskComplete(self):
         return True
 
-    # children must override this, runs the thread in time with tensorflow detections
+    # children must override this, runs the stage in time with tensorflow detections
     def runLoop(self):
         pass
 
-    # children must override this, runs activates the next thread
-    def nextThread(self):
-        pass
-
-# thread for the robot to line follow in the background
+# stage for the robot to line follow until the student id is in view
 
 
-class LineFollowThread(RobotThread):
+class LineFollowStage(Stage):
     # override constructor to add odometry boolean to make sure movements are only counted once
     def __init__(self, robot, videoDisplay, detector):
         super().__init__(robot, videoDisplay, detector)
@@ -90,29 +64,25 @@ class LineFollowThread(RobotThread):
         self.hasMoved = True  # this is the most convenient place to change this before runLoop()
         return False
 
-    # moves on to the next thread in order, retrieving the student id
-    def nextThread(self):
-        self.videoDisplay.mode = "retrieve"
-        self.robot.retrieve()
-
-    # thread runs this code to line follow
+    # engine runs this code to line follow
     def runLoop(self):
         if self.hasMoved:
             self.robot.position += 1.5
             print(self.robot.position)
             self.hasMoved = False
         values = self.robot.linesensors.readLineValues()
+        speed = 0.5 * self.speedScale
         if values[0] == values[1]:  # drive forward if same color on both sides
-            self.robot.drive("forward", 0.5)
+            self.robot.drive("forward", speed)
         elif values[0] == "white":  # turn left if only left side is white
-            self.robot.drive("left", 0.5)
+            self.robot.drive("left", speed)
         else:  # turn right if only right side is white
-            self.robot.drive("right", 0.5)
+            self.robot.drive("right", speed)
 
-# thread to grab the student id
+# stage to grab the student id
 
 
-class RetrieveThread(RobotThread):
+class RetrieveStage(Stage):
     # override constructor to add variables
     def __init__(self, robot, videoDisplay, detector):
         super().__init__(robot, videoDisplay, detector)
@@ -125,12 +95,7 @@ class RetrieveThread(RobotThread):
             return False
         return True
 
-    # move to the next thread, navigating to the exit
-    def nextThread(self):
-        self.videoDisplay.mode = "findcrocs"
-        self.robot.findCrocs()
-
-    # thread runs this code in the loop, finds and drives to the student id
+    # engine runs this code in the loop, finds and drives to the student id
     def runLoop(self):
         oldStudentidCoordinates = self.studentidCoordinates
         # copy to prevent modification by other threads
@@ -158,10 +123,10 @@ class RetrieveThread(RobotThread):
                 self.robot.position += 1
             self.robot.stop()
 
-# thread to locate and drive to the crocs
+# stage to locate and drive to the crocs
 
 
-class findCrocsThread(RobotThread):
+class FindCrocsStage(Stage):
     # override constructor to add variables
     def __init__(self, robot, videoDisplay, detector):
         super().__init__(robot, videoDisplay, detector)
@@ -179,17 +144,11 @@ class findCrocsThread(RobotThread):
             return True
         return False
 
-    # move to the next thread, navigating to the exit
-    def nextThread(self):
-        self.videoDisplay.mode = "finddoor"
-        self.robot.findDoor()
-
-    # override this to also change the self.moved variable
+    # override this to change the self.moved variable
     def tfFinished(self):
-        super().tfFinished()
         self.moved = False
 
-    # thread runs this code in the loop, finds and turns towards the crocs
+    # engine runs this code in the loop, finds and turns towards the crocs
     def runLoop(self):
         oldCrocCoordinates = self.crocCoordinates
         # copy to prevent modification by other threads
@@ -232,14 +191,14 @@ class findCrocsThread(RobotThread):
         # scan for the crocs if they are not currently visible
         elif not crocsFound and not self.moved:
             self.moved = True
-            self.robot.drive("right")
+            self.robot.drive(self.scanDirection("crocs"))
             time.sleep(0.3)
         self.robot.stop()
 
-# thread to locate and drive to the door
+# stage to locate and drive to the door
 
 
-class findDoorThread(RobotThread):
+class FindDoorStage(Stage):
     # override constructor to add variables
     def __init__(self, robot, videoDisplay, detector):
         super().__init__(robot, videoDisplay, detector)
@@ -249,6 +208,9 @@ class findDoorThread(RobotThread):
         self.podsWidth = None
         self.moved = False
         self.podsTargetWidth = 200
+
+    # turn away from the crocs before looking for the tide pods
+    def enter(self):
         self.robot.drive("right")
         time.sleep(0.5)
         self.robot.stop()
@@ -260,23 +222,20 @@ class findDoorThread(RobotThread):
             return True
         return False
 
-    # drive to the door and go back to idle, delivering the card
-    def nextThread(self):
+    # drive to the door, delivering the card
+    def exit(self):
         self.robot.drive("left")
         time.sleep(1.5)
         self.robot.drive("forward")
         time.sleep(6)
         self.robot.stop()
-        self.videoDisplay.mode = "idle"
-        self.robot.thread = None
         self.videoDisplay.finished = True
 
-    # override this to also change the self.moved variable
+    # override this to change the self.moved variable
     def tfFinished(self):
-        super().tfFinished()
         self.moved = False
 
-    # thread runs this code in the loop, goes to the tide pods
+    # engine runs this code in the loop, goes to the tide pods
     def runLoop(self):
         oldPodsCoordinates = self.podsCoordinates
         # copy to prevent modification by other threads
@@ -310,6 +269,189 @@ class findDoorThread(RobotThread):
         # scan for the tide pods if they are not currently visible
         elif not podsFound and not self.moved:
             self.moved = True
-            self.robot.drive("right")
+            self.robot.drive(self.scanDirection("tidepods"))
             time.sleep(0.3)
         self.robot.stop()
+
+# the mission, one entry per stage, keyed by the app mode shown while it runs
+# stage: the Stage class to run
+# guard: the stage method that must pass on a frame taken while stopped before moving on
+# next: the stage to hand off to once the guard passes, None to finish the mission
+# timeout: seconds before the stage gives up and the robot goes back to idle
+# period: seconds per control loop iteration held on deadlines, None for stages that time their own moves
+# priority, cpu: optional real-time priority and cpu for the engine thread while the stage runs
+missionStages = {
+    "search": {"stage": LineFollowStage, "guard": "taskComplete", "next": "retrieve", "timeout": 300,
+               "period": 0.02, "priority": 10, "cpu": None},
+    "retrieve": {"stage": RetrieveStage, "guard": "taskComplete", "next": "findcrocs", "timeout": 120,
+                 "period": None},
+    "findcrocs": {"stage": FindCrocsStage, "guard": "taskComplete", "next": "finddoor", "timeout": 180,
+                  "period": None},
+    "finddoor": {"stage": FindDoorStage, "guard": "taskComplete", "next": None, "timeout": 180,
+                 "period": None},
+}
+
+# runs the mission stages as a state machine on a single persistent thread
+
+
+class MissionEngine(threading.Thread):
+    # constructor, takes robot and the stage definitions as input
+    def __init__(self, robot, stages=missionStages):
+        super().__init__(name="mission", daemon=True)
+        self.robot = robot
+        self.stages = stages
+        self.stage = None
+        self.stageName = None
+        self.stageStartTime = 0
+        self.stageInferences = 0
+        self.controlLoop = None  # paces stages that have a period
+        self.idlePeriod = 0.005  # sleep between iterations of stages without one, so they don't spin
+        self.pauseFlag = False
+        self.tfFinishedFlag = False
+        self.waitedOnce = False
+        self.shutdownFlag = False
+        # requests from other threads, applied by the engine between loop iterations
+        self.requestLock = threading.Lock()
+        self.requestedStage = None
+        self.stopRequested = False
+        self.wakeEvent = threading.Event()
+        self.idleEvent = threading.Event()
+        self.idleEvent.set()
+
+    # start the mission at the given stage, called from the gui thread
+    def begin(self, name):
+        with self.requestLock:
+            self.requestedStage = name
+            self.stopRequested = False
+            self.idleEvent.clear()
+        self.wakeEvent.set()
+
+    # stop the current stage and wait for the robot to be idle
+    def stop(self):
+        with self.requestLock:
+            self.requestedStage = None
+            self.stopRequested = True
+        self.wakeEvent.set()
+        while not self.idleEvent.wait(0.1) and self.is_alive():
+            pass
+
+    # stop the engine for good
+    def shutdown(self):
+        self.shutdownFlag = True
+        self.stop()
+        self.join()
+
+    # this method is called when a new inference is available
+    def tfFinished(self):
+        self.tfFinishedFlag = True
+        stage = self.stage
+        if stage:
+            stage.tfFinished()
+
+    # this method sets the pause flag to true, temporarily stopping the loop
+    def pause(self):
+        self.pauseFlag = True
+        self.waitedOnce = False
+        self.robot.stop()
+
+    # this method sets the pause flag to false, enabling movement again
+    def resume(self):
+        self.pauseFlag = False
+
+    # runs the active stage in time with inferences, moving between stages as their guards pass
+    def run(self):
+        while not self.shutdownFlag:
+            self.applyRequests()
+            if self.stage == None:  # idle, sleep until a stage is requested
+                self.wakeEvent.wait(0.1)
+                self.wakeEvent.clear()
+                continue
+            definition = self.stages[self.stageName]
+            if time.time() - self.stageStartTime > definition["timeout"]:
+                self.finishStage("timed out")
+                self.enterIdle()
+                continue
+            if self.tfFinishedFlag:  # if tensorflow inference is available
+                self.tfFinishedFlag = False
+                self.stageInferences += 1
+                if self.waitedOnce:  # if this is the second frame (frame from stopping point)
+                    self.waitedOnce = False
+                    if getattr(self.stage, definition["guard"])():  # if task is finished, move on
+                        self.stage.exit()
+                        self.finishStage("complete")
+                        if definition["next"] == None:
+                            self.enterIdle()
+                        else:
+                            self.enterStage(definition["next"], True)
+                        continue
+                    else:
+                        self.resume()
+                        self.robot.videoDisplay.startTime = time.time()
+                else:
+                    self.waitedOnce = True
+            if self.pauseFlag:  # if the pause flag is raised, do not do anything
+                self.robot.stop()
+            else:
+                self.stage.runLoop()  # otherwise, do the action specified by the stage
+            if self.controlLoop:
+                self.controlLoop.wait()
+                self.stage.speedScale = self.controlLoop.speedScale
+            else:
+                time.sleep(self.idlePeriod)
+        self.robot.stop()
+
+    # take over any stage change requested by another thread
+    def applyRequests(self):
+        with self.requestLock:
+            requestedStage = self.requestedStage
+            stopRequested = self.stopRequested
+            self.requestedStage = None
+            self.stopRequested = False
+        if stopRequested or (requestedStage and self.stage):
+            if self.stage:
+                self.finishStage("stopped")
+            self.enterIdle()
+        if requestedStage:
+            self.enterStage(requestedStage, False)
+
+    # make a stage active
+    # handoff is true when the previous stage just passed its guard, the robot is stopped and the
+    # latest inference was taken from the stopping point, so the next inference can be judged
+    # straight away instead of waiting for a second one
+    def enterStage(self, name, handoff):
+        self.stageName = name
+        self.stage = self.stages[name]["stage"](self.robot, self.robot.videoDisplay, self.robot.detector)
+        self.robot.videoDisplay.mode = name
+        self.robot.videoDisplay.startTime = time.time()
+        self.stageStartTime = time.time()
+        self.stageInferences = 0
+        self.pauseFlag = False
+        self.waitedOnce = handoff
+        if not handoff:
+            self.tfFinishedFlag = False
+        self.idleEvent.clear()
+        definition = self.stages[name]
+        if definition.get("period"):
+            self.controlLoop = ControlLoop(definition["period"], definition.get("priority"), definition.get("cpu"))
+            applied = self.controlLoop.applyScheduling()
+            if applied:
+                print("stage {} running with {}".format(name, ", ".join(applied)))
+        self.stage.enter()
+
+    # log how long the active stage ran for
+    def finishStage(self, reason):
+        print("stage {} {} after {:.1f}s and {} inferences".format(self.stageName, reason,\
+            time.time() - self.stageStartTime, self.stageInferences))
+        if self.controlLoop:
+            print(self.controlLoop.report())
+            self.controlLoop.restoreScheduling()
+            self.controlLoop = None
+
+    # stop the robot and go back to idle
+    def enterIdle(self):
+        self.robot.stop()
+        self.stage = None
+        self.stageName = None
+        self.pauseFlag = False
+        self.robot.videoDisplay.mode = "idle"
+        self.idleEvent.set()
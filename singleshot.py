@@ -6,29 +6,74 @@
 import numpy as np
 import cv2
 import os
+import time
 from PIL import Image, ImageTk
 import threading
 from detections import *
 
+# define paths and information about the tensorflow model
+labels = ["background", "crocs", "recycling", "skateboard", "studentid", "tidepods"]
+protoPath = "graph.pbtxt"
+optimizedProtoPath = "graph_optimized.pbtxt" # written by optimizegraph.py
+modelPath = "frozen_inference_graph.pb"
+confidenceErrorMargin = 0.2
+captureResolution = "384x288" # fswebcam's default, what the detector and its calibrations were tuned on
+tiledCaptureResolution = "1280x960" # the same 4:3 frame with enough detail for tiles to find more
+
+# read the settings from the header of a graph written by optimizegraph.py, None for any other graph
+# an optimized graph has its normalization done while building the input blob, and only works at
+# the input size its prior boxes were computed for
+def readGraphSettings(protoPath):
+	with open(protoPath) as protoFile:
+		header = protoFile.readline()
+	if not header.startswith("# optimized"):
+		return None
+	settings = dict(setting.split("=") for setting in header.split()[2:])
+	return {"inputSize": int(settings["inputSize"]), "scale": float(settings["scale"]), "mean": float(settings["mean"])}
+
 # thread for the detector to run in the background
 class DetectorThread(threading.Thread):
 	# constructor, takes detector as input
 	def __init__(self, detector):
-		super().__init__()
+		super().__init__(name="detector")
 		self.detector = detector
 	# thread runs this code
 	def run(self):
-		SSD.takeImage("currentFrame.jpg")
-		self.detector.detectObjects()
+		# only pay for the larger capture when the frame may get a tiled second look
+		tiled = self.detector.wantsTiles()
+		SSD.takeImage("currentFrame.jpg", tiledCaptureResolution if tiled else captureResolution)
+		self.detector.detectObjects(tiled)
 
 # class for single shot detectors
 class SSD(object):
 	# constructor, takes a model and its corresponding information as input
-	def __init__(self, protoPath, modelPath, labels, confidenceErrorMargin):
+	# tiled enables a second, closer look at the full resolution frame when the normal pass finds nothing
+	# maxTiles caps the size of that batch, larger frames are scaled down until their tiles fit
+	# maxTiledShare caps the fraction of detection time spent on tiles, so most empty frames skip them
+	def __init__(self, protoPath, modelPath, labels, confidenceErrorMargin, tiled=False, tileOverlap=0.25, nmsThreshold=0.45, maxTiles=6,\
+		maxTiledShare=0.5):
 		self.labels = labels
 		self.confidenceErrorMargin = confidenceErrorMargin
 		self.net = cv2.dnn.readNetFromTensorflow(modelPath, protoPath)
 		self.imageSize = 300
+		self.inputScale = 1.0
+		self.inputMean = 0.0
+		self.fixedInputSize = None
+		settings = readGraphSettings(protoPath)
+		if settings:
+			self.fixedInputSize = settings["inputSize"]
+			self.inputScale = settings["scale"]
+			self.inputMean = settings["mean"]
+		self.tiled = tiled
+		self.tileOverlap = tileOverlap # fraction of a tile shared with its neighbour
+		self.maxTiles = maxTiles
+		self.maxTiledShare = maxTiledShare
+		self.detectSeconds = 0 # recent time spent detecting, decayed each frame
+		self.tiledSeconds = 0 # the part of it spent on tiles
+		self.nmsThreshold = nmsThreshold # overlap above which the weaker of two same-label boxes is dropped
+		self.labelData = []
+		self.memory = ObjectMemory(labels)
+		self.robot = None # this must be set manually, its pose is stored with each sighting
 	
 	# initialize the camera by changing uvcvideo settings
 	# without this, usb webcams are glitchy on a raspberry pi
@@ -39,31 +84,126 @@ class SSD(object):
 	
 	@staticmethod
 	# take an image from command line
-	def takeImage(fileName):
-		os.system("sudo fswebcam -S 20 -d /dev/video0 " + fileName)
+	def takeImage(fileName, resolution=captureResolution):
+		os.system("sudo fswebcam -S 20 -d /dev/video0 -r " + resolution + " " + fileName)
 	
 	# converts current frame to a tkinter image
 	def getCurrTkImage(self):
 		b, g, r = cv2.split(cv2.resize(cv2.imread("currentFrame.jpg"), (self.imageSize, self.imageSize)))
 		return ImageTk.PhotoImage(Image.fromarray(cv2.merge((r, g, b))))
 	
+	# returns True if the next empty frame may get a tiled second look without going over its share of the time
+	def wantsTiles(self):
+		return self.tiled and self.tiledSeconds <= self.maxTiledShare * self.detectSeconds
+
 	# detect objects in the current image, dump information in labelData
-	def detectObjects(self):
+	# tiled allows the tiled second look for this frame, by default if wantsTiles() does
+	def detectObjects(self, tiled=None):
+		if tiled == None:
+			tiled = self.wantsTiles()
+		start = time.perf_counter()
+		self.detectSeconds *= 0.9
+		self.tiledSeconds *= 0.9
+		image = cv2.imread("currentFrame.jpg")
 		# load the current frame at 300x300 pixels, as this version of mobilenet requires
-		frame = cv2.resize(cv2.imread("currentFrame.jpg"), (self.imageSize, self.imageSize))
+		frame = cv2.resize(image, (self.imageSize, self.imageSize))
 		frameH = frame.shape[0]
 		frameW = frame.shape[1]
+		boxes, confidences, labelIndices = self.filterDetections(self.forward(frame))
+		# small or distant objects vanish when the whole frame is squashed, so look again in tiles
+		if tiled and len(boxes) == 0:
+			tiledStart = time.perf_counter()
+			boxes, confidences, labelIndices = self.detectTiled(image)
+			self.tiledSeconds += time.perf_counter() - tiledStart
+		boxes = boxes * np.array([frameW, frameH, frameW, frameH]) # convert to pixel values
+		labelData = []
+		for boundingBox, confidence, labelIndex in zip(boxes, confidences, labelIndices):
+			x0, y0, x1, y1 = boundingBox.astype("int") # convert to integer pixel value approximations
+			labelData.append((self.labels[labelIndex], confidence, (x0, y0, x1, y1)))
+		self.labelData = labelData
+		self.detectSeconds += time.perf_counter() - start
+		if self.robot == None:
+			self.memory.record(labelIndices, confidences, (boxes[:, 0] + boxes[:, 2]) / (2 * frameW))
+		else:
+			self.memory.record(labelIndices, confidences, (boxes[:, 0] + boxes[:, 2]) / (2 * frameW),\
+				self.robot.position, self.robot.accuratePosition)
+
+	# run a bgr image through the network at the given input size, the model's own size by default
+	# returns the detection_out rows: batch index, label index, confidence and corners (0 to 1)
+	def forward(self, image, inputSize=None):
+		if inputSize == None:
+			inputSize = self.imageSize
+		if self.fixedInputSize and not inputSize == self.fixedInputSize:
+			raise ValueError("this graph was optimized for {0}x{0} input".format(self.fixedInputSize))
 		# set the current image at the input node
-		self.net.setInput(cv2.dnn.blobFromImage(frame, size=(self.imageSize, self.imageSize), swapRB=True, crop=False))
+		self.net.setInput(self.blobFromImages([image], inputSize))
 		# run image through the network
-		detectedObjects = self.net.forward()
-		self.labelData = []
-		for i in range(detectedObjects.shape[2]): # loop through detected objects
-			confidence = detectedObjects[0, 0, i, 2]
-			if confidence > self.confidenceErrorMargin:
-				boundingBox = detectedObjects[0, 0, i, 3:7] # get the corners (0 to 1)
-				boundingBox *=  np.array([frameW, frameH, frameW, frameH]) # convert to pixel values
-				labelIndex = int(detectedObjects[0, 0, i, 1])
-				x0, y0, x1, y1 = boundingBox.astype("int") # convert to integer pixel value approximations
-				self.labelData.append((self.labels[labelIndex], confidence, (x0, y0, x1, y1)))
-				Detection.detectedLabels.add(self.labels[labelIndex])
+		return self.net.forward()[0, 0]
+
+	# build the input blob for a list of bgr images
+	def blobFromImages(self, images, inputSize):
+		return cv2.dnn.blobFromImages(images, scalefactor=self.inputScale, size=(inputSize, inputSize),\
+			mean=(self.inputMean, self.inputMean, self.inputMean), swapRB=True, crop=False)
+
+	# keep the rows of a detection_out blob above the confidence margin
+	# returns corners (0 to 1), confidences and label indices
+	def filterDetections(self, detectedObjects):
+		detectedObjects = detectedObjects[detectedObjects[:, 2] > self.confidenceErrorMargin]
+		return detectedObjects[:, 3:7].copy(), detectedObjects[:, 2], detectedObjects[:, 1].astype("int")
+
+	# run overlapping full resolution crops through the network as one batch
+	# returns the merged detections with corners (0 to 1) relative to the whole image
+	def detectTiled(self, image):
+		imageH, imageW = image.shape[:2]
+		tileW = min(self.imageSize, imageW)
+		tileH = min(self.imageSize, imageH)
+		origins = [(x, y) for y in self.tileOrigins(imageH, tileH) for x in self.tileOrigins(imageW, tileW)]
+		# every tile costs a forward pass, so shrink large frames until the tiles fit in the batch
+		while len(origins) > self.maxTiles:
+			imageW, imageH = max(tileW, int(imageW * 0.9)), max(tileH, int(imageH * 0.9))
+			origins = [(x, y) for y in self.tileOrigins(imageH, tileH) for x in self.tileOrigins(imageW, tileW)]
+		if not (imageW, imageH) == image.shape[1::-1]:
+			image = cv2.resize(image, (imageW, imageH), interpolation=cv2.INTER_AREA)
+		tiles = [image[y:y + tileH, x:x + tileW] for x, y in origins]
+		self.net.setInput(self.blobFromImages(tiles, self.imageSize))
+		detectedObjects = self.net.forward()[0, 0]
+		detectedObjects = detectedObjects[detectedObjects[:, 2] > self.confidenceErrorMargin]
+		# column 0 is the index of the tile within the batch, use it to shift boxes back into the image
+		origins = np.array(origins, dtype=np.float32)[detectedObjects[:, 0].astype("int")]
+		boxes = detectedObjects[:, 3:7] * np.array([tileW, tileH, tileW, tileH], dtype=np.float32)
+		boxes += np.hstack((origins, origins))
+		boxes /= np.array([imageW, imageH, imageW, imageH], dtype=np.float32)
+		confidences = detectedObjects[:, 2]
+		labelIndices = detectedObjects[:, 1].astype("int")
+		keep = SSD.nonMaxSuppression(boxes, confidences, labelIndices, self.nmsThreshold)
+		return boxes[keep], confidences[keep], labelIndices[keep]
+
+	# starting offsets of tiles along one side of the image, the last tile is flush with the edge
+	def tileOrigins(self, length, tileLength):
+		stride = max(1, int(tileLength * (1 - self.tileOverlap)))
+		origins = list(range(0, length - tileLength + 1, stride))
+		if origins[-1] != length - tileLength:
+			origins.append(length - tileLength)
+		return origins
+
+	# class-aware non maximum suppression, returns the indices of the boxes to keep
+	@staticmethod
+	def nonMaxSuppression(boxes, confidences, labelIndices, threshold):
+		if len(boxes) == 0:
+			return np.zeros(0, dtype="int")
+		# shift each label into its own region so boxes of different labels never overlap
+		shiftedBoxes = boxes + (labelIndices * (boxes.max() + 1))[:, None]
+		x0, y0, x1, y1 = shiftedBoxes.T
+		areas = (x1 - x0) * (y1 - y0)
+		order = confidences.argsort()[::-1]
+		keep = []
+		while order.size > 0:
+			best = order[0]
+			keep.append(best)
+			rest = order[1:]
+			overlapW = np.maximum(0, np.minimum(x1[best], x1[rest]) - np.maximum(x0[best], x0[rest]))
+			overlapH = np.maximum(0, np.minimum(y1[best], y1[rest]) - np.maximum(y0[best], y0[rest]))
+			intersection = overlapW * overlapH
+			overlap = intersection / (areas[best] + areas[rest] - intersection + 1e-9)
+			order = rest[overlap <= threshold]
+		return np.array(keep, dtype="int")